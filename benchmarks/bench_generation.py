@@ -0,0 +1,335 @@
+"""
+Benchmarks of the generation of scripts with synthetic .travis.yml files and
+local git repositories.
+
+Usage::
+
+    python benchmarks/bench_generation.py
+    python benchmarks/bench_generation.py --sizes 1,100,1000 --refs 5000
+    python benchmarks/bench_generation.py --compare benchmarks/results/OLD.json
+
+The results are saved by commit in `benchmarks/results/<sha>.json` to compare
+them between commits. The scripts generated by the parallel and cached modes
+are validated against the serial mode without cache, a difference fails the
+benchmark.
+"""
+from __future__ import print_function
+
+import argparse
+import hashlib
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT_PATH, 'src'))
+
+from travis2docker import cli  # noqa: E402
+from travis2docker.git_run import GitRun  # noqa: E402
+from travis2docker.travis2docker import Travis2Docker  # noqa: E402
+
+timer = getattr(time, 'perf_counter', time.time)
+
+RESULTS_PATH = os.path.join(ROOT_PATH, 'benchmarks', 'results')
+
+
+def make_yml(envs, packages=50, script_lines=200):
+    """Generate a .travis.yml with a matrix of `envs` rows, apt addons and
+    long script sections"""
+    lines = ['language: python', 'addons:', '  apt:', '    sources:',
+             '      - pov-wkhtmltopdf', '    packages:']
+    lines.extend('      - package-%d' % count for count in range(packages))
+    lines.extend(['env:', '  global:', '    - GLOBAL_VAR="global value"',
+                  '  matrix:'])
+    lines.extend('    - TESTS="%d" LINT_CHECK="%d" ROW="row %d"' % (
+        count % 2, (count + 1) % 2, count) for count in range(envs))
+    for section in ('before_install', 'install', 'script', 'after_success'):
+        lines.append('%s:' % section)
+        lines.append('  - export %s_DONE=1' % section.upper())
+        lines.extend('  - echo "%s step %d"' % (section, count)
+                     for count in range(script_lines // 4))
+    return '\n'.join(lines) + '\n'
+
+
+def make_copy_path(path, files=200, size=4096):
+    """Generate a directory of `files` files to copy into the jobs"""
+    os.makedirs(path)
+    for count in range(files):
+        subdir = os.path.join(path, 'dir-%d' % (count % 10))
+        if not os.path.isdir(subdir):
+            os.makedirs(subdir)
+        with open(os.path.join(subdir, 'file-%d' % count), 'wb') as f_copy:
+            f_copy.write(os.urandom(size))
+    return path
+
+
+def git(path, *args, **kwargs):
+    return subprocess.check_output(
+        ['git', '-C', path, '-c', 'user.name=travis2docker',
+         '-c', 'user.email=travis2docker@example.com'] + list(args),
+        **kwargs)
+
+
+def make_repo(path, yml, refs):
+    """Generate a git repository with a commit of `yml` and `refs`
+    branches and pull requests pointing to it"""
+    os.makedirs(path)
+    git(path, 'init', '-q')
+    git(path, 'checkout', '-q', '-b', 'master')
+    with open(os.path.join(path, '.travis.yml'), 'w') as f_yml:
+        f_yml.write(yml)
+    git(path, 'add', '.travis.yml')
+    git(path, 'commit', '-q', '-m', 'benchmark')
+    sha = git(path, 'rev-parse', 'HEAD').decode('utf-8').strip()
+    commands = []
+    for count in range(refs // 2):
+        commands.append('create refs/heads/branch-%d %s\n' % (count, sha))
+        commands.append('create refs/pull/%d/head %s\n' % (count, sha))
+    process = subprocess.Popen(['git', '-C', path, 'update-ref', '--stdin'],
+                               stdin=subprocess.PIPE)
+    process.communicate(''.join(commands).encode('utf-8'))
+    return path
+
+
+def digest_tree(path):
+    """Hash the names, permissions and content of the files of `path`"""
+    sha = hashlib.sha1()
+    for root, dirnames, fnames in os.walk(path):
+        dirnames.sort()
+        for fname in sorted(fnames):
+            if fname == '.t2d-manifest.json':
+                continue
+            fpath = os.path.join(root, fname)
+            sha.update(('%s\0%o\0' % (os.path.relpath(fpath, path),
+                                      os.stat(fpath).st_mode)).encode('utf-8'))
+            with open(fpath, 'rb') as f_tree:
+                sha.update(f_tree.read())
+    return sha.hexdigest()
+
+
+class Benchmark(object):
+
+    def __init__(self, tmp_path, repeat=3):
+        self.tmp_path = tmp_path
+        self.repeat = repeat
+        self.results = {}
+        self.errors = []
+
+    def path(self, *names):
+        return os.path.join(self.tmp_path, *names)
+
+    def measure(self, name, func, setup=None):
+        """Run `func` `repeat` times calling `setup` before each run"""
+        runs = []
+        for _ in range(self.repeat):
+            if setup:
+                setup()
+            start = timer()
+            func()
+            runs.append(timer() - start)
+        runs.sort()
+        self.results[name] = {
+            'min': runs[0],
+            'median': runs[len(runs) // 2],
+            'runs': runs,
+        }
+        print('%-62s min %9.4fs  median %9.4fs' % (
+            name, runs[0], runs[len(runs) // 2]))
+
+    def bench_compute_dockerfile(self, envs, copy_path):
+        yml = make_yml(envs)
+        work_path = self.path('scripts-%d' % envs)
+        copy_paths = [(copy_path, '$HOME/copy')]
+        digests = {}
+        for workers in (1, 4):
+            for cached in (False, True):
+                cache_path = cached and self.path('cache-%d' % envs)
+
+                def generate():
+                    t2d = Travis2Docker(
+                        yml, work_path=work_path, os_kwargs=os_kwargs(),
+                        copy_paths=copy_paths, workers=workers,
+                        cache_path=cache_path)
+                    t2d.compute_dockerfile()
+
+                def clean():
+                    if os.path.isdir(work_path):
+                        shutil.rmtree(work_path)
+                mode = 'envs=%d,workers=%d,cache=%s' % (envs, workers,
+                                                        cached)
+                self.measure('compute_dockerfile[%s]' % mode, generate,
+                             setup=clean)
+                digests[mode] = digest_tree(work_path)
+                # The files already generated are skipped
+                self.measure('compute_dockerfile_incremental[%s]' % mode,
+                             generate)
+        self.validate('compute_dockerfile[envs=%d]' % envs, digests)
+
+    def bench_git(self, refs):
+        repo_path = make_repo(self.path('repo-%d' % refs), make_yml(10), refs)
+        cache_paths = []
+
+        def new_cache():
+            cache_paths.append(self.path('git-cache-%d-%d' % (
+                refs, len(cache_paths))))
+
+        def update_all():
+            with GitRun(repo_path, cache_paths[-1]) as git_obj:
+                git_obj.update()
+
+        def update_revision():
+            with GitRun(repo_path, cache_paths[-1]) as git_obj:
+                git_obj.update('master')
+
+        def get_ref_data():
+            with GitRun(repo_path, cache_paths[0]) as git_obj:
+                git_obj.get_ref_data(['refs/heads', 'refs/pull'])
+        self.measure('git_update_clone[refs=%d]' % refs, update_all,
+                     setup=new_cache)
+        self.measure('git_update_fetch_all[refs=%d]' % refs, update_all)
+        self.measure('git_update_revision[refs=%d]' % refs, update_revision,
+                     setup=new_cache)
+        self.measure('get_ref_data[refs=%d]' % refs, get_ref_data)
+
+    def bench_cli(self, envs, refs):
+        repo_path = make_repo(self.path('cli-repo-%d' % envs), make_yml(envs),
+                              refs)
+        root_path = self.path('cli-root-%d' % envs)
+        argv = [repo_path, 'master', '--root-path', root_path]
+        digests = {}
+        for jobs in (1, 4):
+            mode = 'envs=%d,jobs=%d' % (envs, jobs)
+
+            def clean():
+                if os.path.isdir(root_path):
+                    shutil.rmtree(root_path)
+
+            def main():
+                digests[mode] = digest_tree(cli.main(
+                    argv + ['--jobs', str(jobs)])[0])
+            self.measure('cli_main_cold[%s]' % mode, main, setup=clean)
+            self.measure('cli_main_warm[%s]' % mode, main)
+        self.validate('cli_main[envs=%d]' % envs, digests)
+
+    def validate(self, name, digests):
+        if len(set(digests.values())) > 1:
+            self.errors.append('%s generated different scripts: %s' % (
+                name, json.dumps(digests, sort_keys=True)))
+
+
+def os_kwargs():
+    return {'repo_owner': 'owner', 'repo_project': 'project',
+            'revision': 'master', 'project': 'benchmark'}
+
+
+def get_commit():
+    try:
+        return git(ROOT_PATH, 'rev-parse', 'HEAD').decode('utf-8').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def compare(old_results, new_results, threshold):
+    """Print the ratio of the cases measured by both results
+
+    :return: Names of the cases slower than `threshold` times the old ones
+    """
+    regressions = []
+    for name in sorted(set(old_results) & set(new_results)):
+        old_time = old_results[name]['min']
+        new_time = new_results[name]['min']
+        ratio = new_time / old_time if old_time else 1
+        flag = ''
+        if ratio > threshold:
+            flag = ' REGRESSION'
+            regressions.append(name)
+        print('%-62s %9.4fs -> %9.4fs  x%.2f%s' % (
+            name, old_time, new_time, ratio, flag))
+    return regressions
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument(
+        '--sizes', default='1,100,1000',
+        help="Rows of the env matrix separated by a comma. Default: %(default)s")
+    parser.add_argument(
+        '--refs', type=int, default=2000,
+        help="Branches and pull requests of the git repository. "
+             "Default: %(default)s")
+    parser.add_argument(
+        '--copy-files', type=int, default=200,
+        help="Files of the path copied into every job. Default: %(default)s")
+    parser.add_argument(
+        '--repeat', type=int, default=3,
+        help="Runs of every case, the minimum is compared. "
+             "Default: %(default)s")
+    parser.add_argument(
+        '--output',
+        help="Path of the JSON results. "
+             "Default: benchmarks/results/<commit>.json")
+    parser.add_argument(
+        '--compare',
+        help="Path of the JSON results of other commit to compare")
+    parser.add_argument(
+        '--threshold', type=float, default=1.2,
+        help="Ratio of the time of a case compared to consider it a "
+             "regression. Default: %(default)s")
+    return parser
+
+
+def main(argv=None):
+    args = get_parser().parse_args(argv)
+    sizes = [int(size) for size in args.sizes.split(',')]
+    tmp_path = tempfile.mkdtemp(prefix='t2d-bench-')
+    old_home = os.environ.get('HOME')
+    # The command line copies ~/.ssh into the jobs
+    os.environ['HOME'] = tmp_path
+    os.makedirs(os.path.join(tmp_path, '.ssh'))
+    try:
+        benchmark = Benchmark(tmp_path, args.repeat)
+        copy_path = make_copy_path(os.path.join(tmp_path, 'copy'),
+                                   args.copy_files)
+        for envs in sizes:
+            benchmark.bench_compute_dockerfile(envs, copy_path)
+        benchmark.bench_git(args.refs)
+        benchmark.bench_cli(max(sizes), args.refs)
+    finally:
+        if old_home is not None:
+            os.environ['HOME'] = old_home
+        shutil.rmtree(tmp_path)
+    commit = get_commit()
+    results = {
+        'commit': commit,
+        'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'options': vars(args),
+        'results': benchmark.results,
+        'errors': benchmark.errors,
+    }
+    output = args.output or os.path.join(RESULTS_PATH, commit + '.json')
+    if not os.path.isdir(os.path.dirname(os.path.abspath(output))):
+        os.makedirs(os.path.dirname(os.path.abspath(output)))
+    with open(output, 'w') as f_results:
+        json.dump(results, f_results, indent=1, sort_keys=True)
+    print('Results saved in %s' % output)
+    status = 0
+    for error in benchmark.errors:
+        print('ERROR: ' + error, file=sys.stderr)
+        status = 1
+    if args.compare:
+        with open(args.compare) as f_old:
+            old_results = json.load(f_old)['results']
+        if compare(old_results, benchmark.results, args.threshold):
+            status = 1
+    return status
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -5,6 +5,7 @@ from __future__ import print_function
 
 import io
 import re
+import sys
 from glob import glob
 from os.path import basename
 from os.path import dirname
@@ -13,6 +14,7 @@ from os.path import splitext
 
 from setuptools import find_packages
 from setuptools import setup
+from setuptools.command.build_py import build_py
 
 
 def read(*names, **kwargs):
@@ -22,6 +24,28 @@ def read(*names, **kwargs):
     ).read()
 
 
+class BuildPy(build_py):
+    """Precompile the bundled templates into python modules, so they are
+    not parsed by every new process"""
+
+    def run(self):
+        build_py.run(self)
+        if self.dry_run:
+            return
+        sys.path.insert(0, self.build_lib)
+        try:
+            from travis2docker import templating
+        except ImportError:
+            # jinja2 is not installed yet, the templates are parsed at runtime
+            return
+        finally:
+            sys.path.pop(0)
+        package_path = join(self.build_lib, 'travis2docker')
+        templating.compile_templates(
+            join(package_path, 'templates'),
+            join(package_path, 'templates_compiled'))
+
+
 setup(
     name='travis2docker',
     version='3.0.13',
@@ -39,6 +63,7 @@ setup(
     py_modules=[splitext(basename(path))[0] for path in glob('src/*.py')],
     include_package_data=True,
     zip_safe=False,
+    cmdclass={'build_py': BuildPy},
     classifiers=[
         # complete classifier list: http://pypi.python.org/pypi?%3Aaction=list_classifiers
         'Development Status :: 5 - Production/Stable',
@@ -66,13 +91,13 @@ setup(
     ],
     install_requires=read('requirements.txt').split('\n'),
     extras_require={
-        # eg:
-        #   'rst': ['docutils>=0.11'],
-        #   ':python_version=="2.6"': ['argparse'],
+        'zstd': ['zstandard'],
     },
     entry_points={
         'console_scripts': [
             'travisfile2dockerfile = travis2docker.cli:main',
+            'travisfile2dockerfile-batch = travis2docker.batch:main',
+            'travisfile2dockerfile-run = travis2docker.runner:main',
         ]
     },
 )
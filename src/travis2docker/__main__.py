@@ -14,8 +14,10 @@ from .cli import main
 
 if __name__ == "__main__":
     FNAME_SCRIPTS = main()
-    stdout.write(
-        'Script generated: \n' +
-        '\n'.join(FNAME_SCRIPTS) +
-        '\n'
-    )
+    # Nothing is generated if the context is written to stdout
+    if FNAME_SCRIPTS:
+        stdout.write(
+            'Script generated: \n' +
+            '\n'.join(FNAME_SCRIPTS) +
+            '\n'
+        )
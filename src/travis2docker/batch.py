@@ -0,0 +1,242 @@
+"""
+Command line app to generate the scripts of many repositories and revisions
+in one invocation.
+
+The entries of the manifest are grouped by repository, so the cache of each
+repository is updated once with a fetch of all its revisions. Then the
+scripts of every entry are generated by a pool of workers.
+"""
+import argparse
+import collections
+import csv
+import json
+import shlex
+import sys
+from os.path import join
+from os.path import splitext
+
+from .cli import generate
+from .cli import get_parser
+from .cli import get_revision_data
+from .cli import validate_args
+from .git_run import GitRun
+
+
+def read_manifest(path, manifest_format=None):
+    """Read the entries of a manifest
+
+    Every entry has the keys 'repo', 'revision' and optionally 'options'
+    with the arguments of the command line for this entry. The options
+    are a list or a string split as a shell does.
+
+    :param path str: Path of the manifest or '-' for stdin
+    :param manifest_format str: 'yaml', 'json' or 'csv'.
+        Default: From the extension of the file or 'yaml'
+    :return: List of entries
+    """
+    if manifest_format is None:
+        manifest_format = {'.csv': 'csv', '.json': 'json'}.get(
+            splitext(path)[1].lower(), 'yaml')
+    f_manifest = sys.stdin if path == '-' else open(path)
+    try:
+        if manifest_format == 'csv':
+            entries = list(csv.DictReader(f_manifest))
+        elif manifest_format == 'json':
+            entries = json.load(f_manifest)
+        else:
+            import yaml
+            entries = yaml.safe_load(f_manifest)
+    finally:
+        if f_manifest is not sys.stdin:
+            f_manifest.close()
+    if isinstance(entries, dict):
+        entries = entries.get('entries')
+    return entries or []
+
+
+def parse_entry(entry, common_args=None):
+    """Parse the arguments of the command line of an entry
+
+    :param entry dict: Entry of the manifest
+    :param common_args list: Arguments for all the entries. The options of
+        the entry have priority over them.
+    :return: Namespace of `cli.get_parser`
+    """
+    options = entry.get('options') or []
+    if not isinstance(options, list):
+        options = shlex.split(options)
+    argv = [entry['repo'], str(entry['revision'])] + \
+        list(common_args or []) + [str(option) for option in options]
+    try:
+        args = get_parser().parse_args(argv)
+    except SystemExit:
+        raise ValueError("Invalid options %s" % argv)
+    error = validate_args(args)
+    if error:
+        raise ValueError("Invalid options %s: %s" % (argv, error))
+    return args
+
+
+def format_error(error):
+    return "%s: %s" % (type(error).__name__, error)
+
+
+def update_repo(entries_args):
+    """Update once the repository of entries with the same repository and
+    get the data of their revisions
+
+    :param entries_args list: List of tuples (index, args) of the entries.
+        All of them have the same --partial-clone and --depth.
+    :return: List of tuples (index, revision data, error message)
+    """
+    _, first_args = entries_args[0]
+    try:
+        with GitRun(first_args.git_repo_url,
+                    join(first_args.root_path, 'repo'),
+                    path_prefix_repo=True,
+                    partial=first_args.partial_clone,
+                    depth=first_args.depth) as git_obj:
+            if any(args.full_fetch for _, args in entries_args):
+                git_obj.update()
+            else:
+                revisions = sorted(set(
+                    args.git_revision for _, args in entries_args
+                    if not git_obj.is_updated(args.git_revision,
+                                              args.fetch_ttl)))
+                if revisions:
+                    git_obj.update(revisions)
+            return [(index, get_revision_data(git_obj, args.git_revision),
+                     None) for index, args in entries_args]
+    except Exception as error:
+        return [(index, None, format_error(error))
+                for index, _ in entries_args]
+
+
+def check_entry(index, args, work_paths, repos):
+    """Check an entry does not conflict with the previous entries
+
+    The scripts of the entries with the same repository, revision and root
+    path would be written in the same work path. The repository of an entry
+    is updated once with the options of the first entry of the repository.
+
+    :param index int: Index of the entry in the manifest
+    :param args: Namespace of `parse_entry` of the entry
+    :param work_paths dict: Index of the previous entry of each work path.
+        The work path of the entry is added.
+    :param repos dict: Tuples (index, args) of the previous entries of each
+        repository and root path
+    """
+    work_path = (GitRun.url2dirname(args.git_repo_url), args.git_revision,
+                 args.root_path)
+    if work_path in work_paths:
+        raise ValueError(
+            "Same repository, revision and root path as the entry %d, "
+            "use other --root-path" % work_paths[work_path])
+    repo_entries = repos.get((args.git_repo_url, args.root_path))
+    if not args.no_clone and repo_entries:
+        first_index, first_args = repo_entries[0]
+        if (args.partial_clone, args.depth) != (first_args.partial_clone,
+                                                first_args.depth):
+            raise ValueError(
+                "Other --partial-clone or --depth than the entry %d of the "
+                "same repository" % first_index)
+    work_paths[work_path] = index
+
+
+def run_batch(entries, common_args=None, workers=1):
+    """Generate the scripts of every entry of a manifest
+
+    :param entries list: Entries of `read_manifest`
+    :param common_args list: Arguments of command line for all the entries
+    :param workers int: Number of repositories and entries processed in
+        parallel
+    :return: dict with the summary of every entry in the same order
+    """
+    from multiprocessing.pool import ThreadPool
+    results = []
+    entries_args = {}
+    work_paths = {}
+    repos = collections.OrderedDict()
+    for index, entry in enumerate(entries):
+        results.append({
+            'repo': entry.get('repo'), 'revision': entry.get('revision'),
+            'work_paths': [], 'stats': {}, 'error': None,
+        })
+        try:
+            args = parse_entry(entry, common_args)
+            check_entry(index, args, work_paths, repos)
+        except (KeyError, ValueError) as error:
+            results[index]['error'] = format_error(error)
+            continue
+        entries_args[index] = args
+        if not args.no_clone:
+            repos.setdefault((args.git_repo_url, args.root_path), []).append(
+                (index, args))
+    revisions_data = {}
+    pool = ThreadPool(max(workers, 1))
+    try:
+        for repo_data in pool.map(update_repo, list(repos.values())):
+            for index, os_kwargs, error in repo_data:
+                revisions_data[index] = os_kwargs
+                results[index]['error'] = error
+
+        def generate_entry(index):
+            if results[index]['error']:
+                return
+            os_kwargs = revisions_data.get(index)
+            try:
+                work_paths, stats = generate(entries_args[index], os_kwargs)
+            except Exception as error:
+                results[index]['error'] = format_error(error)
+                return
+            results[index].update(work_paths=work_paths, stats=stats)
+        pool.map(generate_entry, sorted(entries_args))
+    finally:
+        pool.close()
+        pool.join()
+    return {
+        'entries': results,
+        'failures': len([result for result in results if result['error']]),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Generate the scripts of many repositories and "
+                    "revisions listed in a manifest.",
+        epilog="Other arguments are used for all the entries, e.g. "
+               "--root-path=PATH. Use the '--option=value' syntax for them.",
+    )
+    parser.add_argument(
+        "manifest",
+        help="YAML, JSON or CSV file with the entries to generate. Each "
+             "entry has 'repo', 'revision' and optional 'options' with "
+             "arguments of travisfile2dockerfile for this entry."
+             "\nUse '-' to read it from stdin.",
+    )
+    parser.add_argument(
+        '--format', dest='manifest_format', choices=('yaml', 'json', 'csv'),
+        help="Format of the manifest."
+             "\nDefault: From the extension of the file or 'yaml'",
+    )
+    parser.add_argument(
+        '--workers', dest='workers', type=int, default=4,
+        help="Number of repositories and entries processed in parallel."
+             "\nDefault: 4",
+    )
+    parser.add_argument(
+        '--summary', dest='summary', default='-',
+        help="Path of the JSON summary of the work paths generated and "
+             "the failures."
+             "\nDefault: stdout",
+    )
+    args, common_args = parser.parse_known_args(argv)
+    summary = run_batch(read_manifest(args.manifest, args.manifest_format),
+                        common_args, args.workers)
+    content = json.dumps(summary, indent=1, sort_keys=True) + '\n'
+    if args.summary == '-':
+        sys.stdout.write(content)
+    else:
+        with open(args.summary, 'w') as f_summary:
+            f_summary.write(content)
+    return 1 if summary['failures'] else 0
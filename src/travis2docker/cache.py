@@ -0,0 +1,274 @@
+"""Helpers to keep data cached on disk between runs of travis2docker.
+
+The caches are optional: any error reading or writing them is ignored and
+the caller computes the data again.
+"""
+import errno
+import hashlib
+import marshal
+import os
+import shutil
+import stat
+import tempfile
+import threading
+
+# os.rename does not overwrite an existing file on Windows
+replace = getattr(os, 'replace', os.rename)
+
+
+def mkdir_p(path):
+    """Create a directory and its parents if they do not exist
+
+    :param path str: Path of the directory
+    """
+    try:
+        os.makedirs(path)
+    except OSError as os_error:
+        # Created by other process at the same time
+        if os_error.errno != errno.EEXIST or not os.path.isdir(path):
+            raise
+
+
+def read_marshal(path):
+    """Load the data dumped with `write_marshal`
+
+    :param path str: Path of the cache file
+    :return: The data cached or None if it is missing or corrupted
+    """
+    try:
+        with open(path, 'rb') as f_cache:
+            return marshal.load(f_cache)
+    except (IOError, OSError, EOFError, ValueError, TypeError):
+        return None
+
+
+def write_marshal(path, data):
+    """Dump `data` into `path` atomically
+
+    :param path str: Path of the cache file
+    :param data: Data supported by `marshal` module
+    :return: True if the cache was written
+    """
+    dirname = os.path.dirname(path)
+    try:
+        mkdir_p(dirname)
+    except OSError:
+        return False
+    tmp_path = None
+    try:
+        fd_tmp, tmp_path = tempfile.mkstemp(dir=dirname, prefix='.tmp-')
+        with os.fdopen(fd_tmp, 'wb') as f_cache:
+            marshal.dump(data, f_cache)
+        replace(tmp_path, path)
+    except (IOError, OSError, ValueError):
+        if tmp_path and os.path.isfile(tmp_path):
+            os.remove(tmp_path)
+        return False
+    return True
+
+
+def digest_path(path):
+    """Compute a hash of the content of a file or a directory
+
+    The relative names and the permissions of the files are part of the
+    hash, so a chmod or a rename changes it too.
+
+    :param path str: Path of a file or a directory
+    :return: Hexadecimal sha1
+    """
+    sha = hashlib.sha1()
+    if not os.path.isdir(path):
+        _digest_file(sha, '', path)
+        return sha.hexdigest()
+    for root, dirnames, fnames in os.walk(path):
+        dirnames.sort()
+        for fname in sorted(fnames):
+            fpath = os.path.join(root, fname)
+            _digest_file(sha, os.path.relpath(fpath, path), fpath)
+        if not fnames and not dirnames:
+            # Empty directories are copied too
+            sha.update(('%s\0' % os.path.relpath(root, path)).encode('utf-8'))
+    return sha.hexdigest()
+
+
+def _digest_file(sha, relpath, fpath):
+    mode = stat.S_IMODE(os.stat(fpath).st_mode)
+    sha.update(('%s\0%o\0' % (relpath, mode)).encode('utf-8'))
+    with open(fpath, 'rb') as f_digest:
+        for chunk in iter(lambda: f_digest.read(1024 * 1024), b''):
+            sha.update(chunk)
+
+
+def signature_path(path):
+    """Compute a cheap hash of a file or a directory from the metadata of
+    its files (names, sizes, permissions and mtimes) without reading them
+
+    :param path str: Path of a file or a directory
+    :return: Hexadecimal sha1
+    """
+    sha = hashlib.sha1()
+    paths = [path]
+    if os.path.isdir(path):
+        for root, dirnames, fnames in os.walk(path):
+            dirnames.sort()
+            paths.extend(os.path.join(root, name)
+                         for name in dirnames + sorted(fnames))
+    for fpath in paths:
+        fstat = os.stat(fpath)
+        sha.update(('%s\0%d\0%o\0%r\0' % (
+            os.path.relpath(fpath, path), fstat.st_size, fstat.st_mode,
+            fstat.st_mtime)).encode('utf-8'))
+    return sha.hexdigest()
+
+
+def link_path(src, dest):
+    """Hardlink the files of `src` into `dest`, creating its directories.
+    The files are copied if the filesystem does not support hardlinks.
+
+    :param src str: Path of a file or a directory
+    :param dest str: Path of the new file or directory
+    """
+    if not os.path.isdir(src):
+        try:
+            os.link(src, dest)
+        except OSError:
+            shutil.copy2(src, dest)
+        return
+    os.makedirs(dest)
+    for fname in os.listdir(src):
+        link_path(os.path.join(src, fname), os.path.join(dest, fname))
+    shutil.copystat(src, dest)
+
+
+class PathStore(object):
+    """Content-addressed store of the paths copied into the jobs.
+
+    Every path is staged once per instance into `<path>/<digest>/<name>`
+    and the jobs get hardlinks to it. The digest of a path is reused from
+    the previous runs while the metadata of its files does not change, so
+    the content is just read again when something changed. When the
+    content of a path changes its previous copy is removed, unless other
+    path has the same content.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.index_path = os.path.join(path, 'index.marshal')
+        self._index = None
+        self._staged = {}
+        self._lock = threading.Lock()
+
+    def stage(self, src):
+        """Copy `src` into the store if it is not there yet
+
+        :param src str: Path of a file or directory
+        :return: tuple (path staged, digest of the content)
+        """
+        with self._lock:
+            if src not in self._staged:
+                self._staged[src] = self._stage(src)
+            return self._staged[src]
+
+    def digest(self, src):
+        """Get the digest of the content of `src` without staging it.
+        It is read only if its metadata changed since it was staged."""
+        with self._lock:
+            return self._digest(src)[1]
+
+    def _digest(self, src):
+        if self._index is None:
+            self._index = read_marshal(self.index_path) or {}
+        signature = signature_path(src)
+        cached = self._index.get(src)
+        if cached and cached[0] == signature:
+            return signature, cached[1]
+        return signature, digest_path(src)
+
+    def _stage(self, src):
+        signature, digest = self._digest(src)
+        staged_dir = os.path.join(self.path, digest)
+        staged_path = os.path.join(staged_dir, os.path.basename(src))
+        if not os.path.exists(staged_path):
+            mkdir_p(staged_dir)
+            tmp_dir = tempfile.mkdtemp(dir=staged_dir, prefix='.tmp-')
+            tmp_path = os.path.join(tmp_dir, os.path.basename(src))
+            try:
+                if os.path.isdir(src):
+                    shutil.copytree(src, tmp_path)
+                else:
+                    shutil.copy2(src, tmp_path)
+                os.rename(tmp_path, staged_path)
+            except OSError:
+                # Staged by other process at the same time
+                if not os.path.exists(staged_path):
+                    raise
+            finally:
+                shutil.rmtree(tmp_dir)
+        previous = self._index.get(src)
+        if previous != [signature, digest]:
+            self._index[src] = [signature, digest]
+            write_marshal(self.index_path, self._index)
+        if previous and previous[1] != digest:
+            self._prune(previous[1])
+        return staged_path, digest
+
+    def _prune(self, digest):
+        """Remove the copy of a digest not used by any path of the index"""
+        if any(cached[1] == digest for cached in self._index.values()):
+            return
+        # The jobs keep their hardlinks to the files removed
+        shutil.rmtree(os.path.join(self.path, digest), ignore_errors=True)
+
+
+class DiskCache(object):
+    """Directory of marshal files with a size limit.
+    The least recently used files are removed when the size is exceeded.
+    """
+
+    def __init__(self, path, max_size):
+        """
+        :param path str: Directory of the cache
+        :param max_size int: Maximum size in bytes of all the files
+        """
+        self.path = path
+        self.max_size = max_size
+
+    def _key_path(self, key):
+        return os.path.join(self.path, key + '.marshal')
+
+    def get(self, key):
+        """Get the data cached with `key` or None"""
+        key_path = self._key_path(key)
+        data = read_marshal(key_path)
+        if data is not None:
+            try:
+                # The mtime is the last use for the eviction
+                os.utime(key_path, None)
+            except OSError:
+                pass
+        return data
+
+    def set(self, key, data):
+        """Cache `data` with `key` and evict the least recently used"""
+        if write_marshal(self._key_path(key), data):
+            self.evict()
+
+    def evict(self):
+        try:
+            entries = []
+            for fname in os.listdir(self.path):
+                if not fname.endswith('.marshal'):
+                    continue
+                fstat = os.stat(os.path.join(self.path, fname))
+                entries.append((fstat.st_mtime, fstat.st_size, fname))
+        except OSError:
+            return
+        size = sum(entry[1] for entry in entries)
+        for _, fsize, fname in sorted(entries):
+            if size <= self.max_size:
+                break
+            try:
+                os.remove(os.path.join(self.path, fname))
+            except OSError:
+                pass
+            size -= fsize
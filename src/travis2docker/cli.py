@@ -15,6 +15,8 @@ Why does this file exist, and why not put this in __main__?
 """
 import argparse
 import os
+import sys
+from os.path import exists
 from os.path import expanduser
 from os.path import expandvars
 from os.path import isdir
@@ -23,15 +25,50 @@ from os.path import join
 from tempfile import gettempdir
 
 from . import __version__
+from . import timing
 from .exceptions import InvalidRepoBranchError
-from .git_run import GitRun
-from .travis2docker import Travis2Docker
 
+# The modules importing jinja2 and yaml are imported when they are used, so
+# e.g. `--version`, the errors of arguments and the fetch start faster.
 
-def get_git_data(project, path, revision):
-    git_obj = GitRun(project, path, path_prefix_repo=True)
-    git_obj.update()
-    data = {
+# Maximum size in bytes of the cache of results of previous runs
+RESULT_CACHE_SIZE = 4 * 1024 * 1024
+
+
+def get_git_data(project, path, revision, full_fetch=False, partial=False,
+                 depth=None, fetch_ttl=0):
+    from .git_run import GitRun
+    with timing.span('get_git_data', 'git'), \
+            GitRun(project, path, path_prefix_repo=True, partial=partial,
+                   depth=depth) as git_obj:
+        if not git_obj.is_updated(revision, fetch_ttl):
+            git_obj.update(None if full_fetch else revision)
+        return get_revision_data(git_obj, revision)
+
+
+def get_git_bundle(project, path, revision, bundles_path):
+    """Get the git bundle of a revision of the cache, created once by
+    sha and ref
+
+    :return: Path of the bundle
+    """
+    from .cache import mkdir_p
+    from .git_run import GitRun
+    with timing.span('get_git_bundle', 'git'), \
+            GitRun(project, path, path_prefix_repo=True) as git_obj:
+        sha = git_obj.get_sha(revision)
+        ref = GitRun.revision2refspec(revision).split(':')[0].lstrip('+')
+        bundle_path = join(bundles_path, '%s-%s.bundle' % (
+            sha, GitRun.url2dirname(ref).replace('/', '_')))
+        if not isfile(bundle_path):
+            mkdir_p(bundles_path)
+            git_obj.bundle(revision, bundle_path)
+        return bundle_path
+
+
+def get_revision_data(git_obj, revision):
+    """Get the data of a revision of a repository already updated"""
+    return {
         'sha': git_obj.get_sha(revision),
         'content': git_obj.show_file('.travis.yml', revision),
         'repo_owner': git_obj.owner,
@@ -39,9 +76,8 @@ def get_git_data(project, path, revision):
         'git_email': git_obj.get_config_data("user.email"),
         'git_user': git_obj.get_config_data("user.name"),
         'revision': revision,
-        'project': project,
+        'project': git_obj.repo_git,
     }
-    return data
 
 
 def yml_read(yml_path):
@@ -54,7 +90,7 @@ def yml_read(yml_path):
         return f_yml.read()
 
 
-def main():
+def get_parser():
     parser = argparse.ArgumentParser()
     parser.add_argument(
         "git_repo_url",
@@ -71,7 +107,7 @@ def main():
              "\nYou can use "
              "branch name e.g. master or 8.0 "
              "or pull number with 'pull/#' e.g. pull/1 "
-             "NOTE: A sha e.g. b48228 NOT IMPLEMENTED YET",
+             "or a full sha of 40 characters",
     )
     parser.add_argument(
         '--docker-user', dest='docker_user',
@@ -111,8 +147,10 @@ def main():
     )
     parser.add_argument(
         '--run-extra-args', dest='run_extra_args',
-        help="Extra arguments to `docker run RUN_EXTRA_ARGS` command",
-        default='-itP -e LANG=C.UTF-8',
+        help="Extra arguments to `docker run RUN_EXTRA_ARGS` command."
+             "\nThe interactive arguments -itP are added unless the "
+             "environment variable T2D_RUN_TTY_ARGS is defined.",
+        default='-e LANG=C.UTF-8',
     )
     parser.add_argument(
         '--run-extra-cmds', dest='run_extra_cmds', nargs='*', default="",
@@ -146,11 +184,178 @@ def main():
         help='Optional paths of configuration files to '
         'copy for user\'s HOME path into container, separated by a comma.',
     )
+    parser.add_argument(
+        '--full-fetch', dest='full_fetch', action='store_true',
+        default=False,
+        help="Fetch all the branches and pull requests of the repository "
+             "instead of just the revision of work.",
+    )
+    parser.add_argument(
+        '--partial-clone', dest='partial_clone', action='store_true',
+        default=False,
+        help="Clone the repository without blobs. Just the files read "
+             "e.g. .travis.yml are downloaded.",
+    )
+    parser.add_argument(
+        '--depth', dest='depth', type=int, default=None,
+        help="Limit the history cloned and fetched of the repository "
+             "to this number of commits.",
+    )
+    parser.add_argument(
+        '--fetch-ttl', dest='fetch_ttl', type=int, default=0,
+        help="Seconds that a fetch of the revision is reused by next runs "
+             "without fetching again. A sha already fetched is never "
+             "fetched again."
+             "\nDefault: 0",
+    )
+    parser.add_argument(
+        '--jobs', dest='jobs', type=int, default=1,
+        help="Number of matrix jobs to generate in parallel."
+             "\nDefault: 1",
+    )
+    parser.add_argument(
+        '--force', dest='force', action='store_true', default=False,
+        help="Generate the scripts again even if a previous run used the "
+             "same commit, .travis.yml and options.",
+    )
+    parser.add_argument(
+        '--tar-context', dest='tar_context', action='store_true',
+        default=False,
+        help="Write the build context of each job as a tar archive and "
+             "build it with `docker build - < context.tar`. The paths "
+             "copied are added from their sources.",
+    )
+    parser.add_argument(
+        '--tar-compression', dest='tar_compression',
+        choices=('gzip', 'zstd'),
+        help="Compression of the tar archives of the build contexts. "
+             "zstd requires the zstandard package.",
+    )
+    parser.add_argument(
+        '--tar-stdout', dest='tar_stdout', type=int, metavar='JOB',
+        help="Write the tar archive of the build context of the job number "
+             "JOB of the matrix to stdout, e.g. to pipe it to "
+             "`docker build -`. Nothing is written in the root path.",
+    )
+    parser.add_argument(
+        '--bake', dest='bake', action='store_true', default=False,
+        help="Write a docker-bake.hcl with a target for each job to build "
+             "all of them in parallel with `docker buildx bake`.",
+    )
+    parser.add_argument(
+        '--bake-cache-from', dest='bake_cache_from',
+        help="cache-from of the targets of the bake file separated by a "
+             "space. Use '' to disable it."
+             "\nDefault: A local cache in the root path",
+    )
+    parser.add_argument(
+        '--bake-cache-to', dest='bake_cache_to',
+        help="cache-to of the targets of the bake file separated by a "
+             "space. Use '' to disable it."
+             "\nDefault: A local cache in the root path",
+    )
+    parser.add_argument(
+        '--buildkit', dest='buildkit', action='store_true', default=False,
+        help="Use the syntax of BuildKit in the Dockerfile: the caches of "
+             "downloads of `cache:` (pip, npm, ccache) and the apt "
+             "archives are cache mounts kept between builds.",
+    )
+    parser.add_argument(
+        '--run-cache', dest='run_cache', choices=('repo', 'job'),
+        help="Share the `cache:` directories between the containers of "
+             "the repository or of each job of the matrix with docker "
+             "volumes. Each container copies them at start and back at "
+             "exit with a lock.",
+    )
+    parser.add_argument(
+        '--git-bundle', dest='git_bundle', action='store_true',
+        default=False,
+        help="Add a git bundle of the revision from the local cache to the "
+             "build context of each job and fetch it from the bundle "
+             "instead of the remote, so the build does not use the network "
+             "to get the code.",
+    )
+    parser.add_argument(
+        '--shared-install', dest='shared_install', action='store_true',
+        default=False,
+        help="Define the variables of the matrix after the install "
+             "sections when their scripts do not reference them, so all "
+             "the jobs share the layers of the install. Programs reading "
+             "the variables without a reference in the scripts would not "
+             "get them during the install.",
+    )
+    parser.add_argument(
+        '--timings', dest='timings', action='store_true', default=False,
+        help="Show a table of the time spent by each phase and git command "
+             "in stderr.",
+    )
+    parser.add_argument(
+        '--trace-file', dest='trace_file',
+        help="Path of a JSON file with the time spent by each phase and "
+             "git command in the Chrome trace event format.",
+    )
     parser.add_argument(
         '-v', '--version', action='version', version='%(prog)s ' + __version__
     )
+    return parser
 
-    args = parser.parse_args()
+
+def validate_args(args):
+    """Check the combinations of the options parsed by `get_parser`
+
+    :return: Message of the first invalid combination or None
+    """
+    if args.bake and (args.tar_context or args.tar_stdout is not None):
+        return "--bake requires the build contexts as directories"
+    if args.git_bundle and (args.no_clone or args.partial_clone or
+                            args.depth):
+        return ("--git-bundle requires the full history of the revision "
+                "in the cache, it is not supported with --no-clone, "
+                "--partial-clone or --depth")
+    return None
+
+
+def main(argv=None):
+    parser = get_parser()
+    args = parser.parse_args(argv)
+    error = validate_args(args)
+    if error:
+        parser.error(error)
+    recorder = (args.timings or args.trace_file) and timing.enable()
+    try:
+        with timing.span('generate'):
+            work_paths, stats = generate(args)
+    finally:
+        if recorder:
+            timing.disable()
+            if args.timings:
+                sys.stderr.write(recorder.format_table())
+            if args.trace_file:
+                recorder.write_trace(args.trace_file)
+    if stats.get('cache_hit'):
+        sys.stderr.write("Scripts reused from a previous run\n")
+    else:
+        sys.stderr.write(
+            "Files written: %(written)d, skipped: %(skipped)d, "
+            "deleted: %(deleted)d\n" % stats)
+    return work_paths
+
+
+def generate(args, os_kwargs=None):
+    """Generate the scripts of the arguments parsed by `get_parser`
+
+    :param args: Namespace of the arguments parsed
+    :param os_kwargs dict: Data of the revision of `get_revision_data`.
+        Default: It is got from the repository.
+    :return: tuple (work paths generated, stats of the files written)
+    """
+    from .cache import DiskCache
+    from .git_run import GitRun
+    from .travis2docker import Travis2Docker
+    from .travis2docker import check_manifest
+    from .travis2docker import get_bake_digest
+    from .travis2docker import get_stale_jobs
+    from .travis2docker import read_manifest
     revision = args.git_revision
     git_repo = args.git_repo_url
     docker_user = args.docker_user
@@ -168,7 +373,9 @@ def main():
     rcfiles = [
         (expanduser(rc_file), os.path.join('$HOME', os.path.basename(rc_file)))
         for rc_file in rcfiles_args]
-    if no_clone:
+    if os_kwargs is not None:
+        os_kwargs = dict(os_kwargs)
+    elif no_clone:
         os_kwargs = {
             'repo_owner': 'local_file',
             'repo_project': 'local_file',
@@ -177,7 +384,10 @@ def main():
             'project': git_repo,
         }
     else:
-        os_kwargs = get_git_data(git_repo, join(root_path, 'repo'), revision)
+        os_kwargs = get_git_data(git_repo, join(root_path, 'repo'), revision,
+                                 full_fetch=args.full_fetch,
+                                 partial=args.partial_clone, depth=args.depth,
+                                 fetch_ttl=args.fetch_ttl)
     if travis_yml_path:
         yml_content = yml_read(travis_yml_path)
     else:
@@ -196,20 +406,131 @@ def main():
         'add_self_rsa_pub': True,
         'remotes': remotes,
     })
-    t2d = Travis2Docker(
-        yml_buffer=yml_content,
-        work_path=join(root_path, 'script',
-                       GitRun.url2dirname(git_repo), revision),
-        image=default_docker_image,
-        os_kwargs=os_kwargs,
-        copy_paths=[(expanduser("~/.ssh"), "$HOME/.ssh")] + rcfiles,
-    )
-    t2d.build_extra_params = {
+    work_path = join(root_path, 'script', GitRun.url2dirname(git_repo),
+                     revision)
+    copy_paths = [(expanduser("~/.ssh"), "$HOME/.ssh")] + rcfiles
+    cache_path = join(root_path, 'cache')
+    git_bundle = args.git_bundle and get_git_bundle(
+        git_repo, join(root_path, 'repo'), revision,
+        join(cache_path, 'bundles'))
+    build_extra_params = {
         'extra_params': build_extra_args,
         'extra_cmds': build_extra_cmds,
     }
-    t2d.run_extra_params = {
+    run_extra_params = {
         'extra_params': run_extra_args,
         'extra_cmds': run_extra_cmds,
     }
-    return t2d.compute_dockerfile(skip_after_success=exclude_after_success)
+    buildx_cache_path = join(cache_path, 'buildx')
+    bake_params = {
+        'cache_from': (
+            'type=local,src=%s' % buildx_cache_path
+            if args.bake_cache_from is None else args.bake_cache_from
+        ).split(),
+        'cache_to': (
+            'type=local,dest=%s,mode=max' % buildx_cache_path
+            if args.bake_cache_to is None else args.bake_cache_to
+        ).split(),
+    }
+    result_cache = DiskCache(join(cache_path, 'results'), RESULT_CACHE_SIZE)
+    result_key = get_result_key(
+        cache_path, yml_content, os_kwargs, copy_paths, work_path,
+        default_docker_image, build_extra_params, run_extra_params,
+        exclude_after_success, args.tar_context, args.tar_compression,
+        args.bake and bake_params, args.buildkit, args.run_cache,
+        git_bundle, args.shared_install)
+    with timing.span('result cache', 'cache'):
+        result = None
+        if not args.force and args.tar_stdout is None:
+            result = result_cache.get(result_key)
+    if result and result.get('bake') != get_bake_digest(work_path):
+        result = None
+    if result and get_stale_jobs(work_path, len(result['work_paths'])):
+        # Generated by other run with a bigger matrix, removed on a miss
+        result = None
+    if result and all(
+            check_manifest(result_work_path, manifest)
+            for result_work_path, manifest in zip(result['work_paths'],
+                                                  result['manifests'])):
+        return result['work_paths'], {
+            'written': 0, 'skipped': 0, 'deleted': 0, 'cache_hit': True}
+    t2d = Travis2Docker(
+        yml_buffer=yml_content,
+        work_path=work_path,
+        image=default_docker_image,
+        os_kwargs=os_kwargs,
+        copy_paths=copy_paths,
+        workers=args.jobs,
+        cache_path=cache_path,
+        tar_context=args.tar_context or args.tar_stdout is not None,
+        tar_compression=args.tar_compression,
+        bake=args.bake,
+        buildkit=args.buildkit,
+        run_cache=args.run_cache,
+        git_bundle=git_bundle,
+        shared_install=args.shared_install,
+    )
+    t2d.build_extra_params = build_extra_params
+    t2d.run_extra_params = run_extra_params
+    t2d.bake_params = bake_params
+    if args.tar_stdout is not None:
+        write_job_context(t2d, args.tar_stdout, exclude_after_success)
+        return [], {'written': 0, 'skipped': 0, 'deleted': 0}
+    work_paths = t2d.compute_dockerfile(
+        skip_after_success=exclude_after_success)
+    result_cache.set(result_key, {
+        'work_paths': work_paths,
+        'manifests': [read_manifest(path) for path in work_paths],
+        'bake': get_bake_digest(work_path),
+    })
+    return work_paths, t2d.stats
+
+
+def write_job_context(t2d, job_count, skip_after_success=False):
+    """Write the tar archive of the build context of a job to stdout
+
+    :param t2d Travis2Docker: Generator of the jobs
+    :param job_count int: Number of the job in the matrix starting at 1
+    """
+    from .context import write_context
+    from .travis2docker import BUILD_SCRIPTS
+    for job in t2d.iter_jobs(skip_after_success):
+        if job.count == job_count:
+            stdout = getattr(sys.stdout, 'buffer', sys.stdout)
+            write_context(job, stdout, t2d.tar_compression,
+                          exclude=BUILD_SCRIPTS)
+            return
+    raise UserWarning("The matrix does not have the job %s" % job_count)
+
+
+def get_result_key(cache_path, yml_content, os_kwargs, copy_paths,
+                   *options):
+    """Get the key of the result cache of a run
+
+    It is the hash of the commit, the .travis.yml, the templates, the
+    options used to generate the scripts and the content of the paths
+    copied.
+
+    :param copy_paths list: Tuples (path, destination) of the paths copied
+    :param options: Other values used to generate the scripts
+    """
+    import hashlib
+    import json
+
+    from .cache import PathStore
+    from .cache import digest_path
+    from .templating import TEMPLATES_PATH
+    os_kwargs = dict(os_kwargs)
+    os_kwargs.pop('content', None)
+    store = PathStore(join(cache_path, 'store'))
+    key = json.dumps([
+        __version__,
+        hashlib.sha1(yml_content.encode('utf-8')).hexdigest(),
+        digest_path(TEMPLATES_PATH),
+        os_kwargs,
+        copy_paths,
+        options,
+        [store.digest(expandvars(expanduser(path)))
+         for path, _ in copy_paths if exists(expandvars(expanduser(path)))],
+    ], sort_keys=True)
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()
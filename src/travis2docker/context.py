@@ -0,0 +1,86 @@
+"""Build contexts of the jobs as tar archives ready to pipe to
+`docker build - < context.tar`.
+
+The files generated are added from memory and the paths copied are added
+from their sources, so nothing is staged on disk before the archive.
+"""
+import gzip
+import hashlib
+import io
+import os
+import tarfile
+
+# Name of the archive by compression
+CONTEXT_NAMES = {
+    None: 'context.tar',
+    'gzip': 'context.tar.gz',
+    'zstd': 'context.tar.zst',
+}
+
+
+class HashWriter(object):
+    """File object computing the sha1 of the data written to other one"""
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.sha = hashlib.sha1()
+
+    def write(self, data):
+        self.sha.update(data)
+        self.fileobj.write(data)
+        return len(data)
+
+    def flush(self):
+        self.fileobj.flush()
+
+    def hexdigest(self):
+        return self.sha.hexdigest()
+
+
+def _compressor(fileobj, compression):
+    if compression is None:
+        return fileobj
+    if compression == 'gzip':
+        # Without name and mtime the same context gives the same archive
+        return gzip.GzipFile(filename='', mode='wb', fileobj=fileobj,
+                             mtime=0)
+    if compression == 'zstd':
+        try:
+            import zstandard
+        except ImportError:
+            raise UserWarning(
+                "The zstd compression requires the zstandard package. "
+                "Install it with `pip install travis2docker[zstd]`")
+        return zstandard.ZstdCompressor().stream_writer(fileobj,
+                                                        closefd=False)
+    raise ValueError("Compression not supported: %s" % compression)
+
+
+def write_context(job, fileobj, compression=None, exclude=()):
+    """Write the build context of a job as a tar archive
+
+    :param job Job: Job computed by `Travis2Docker.iter_jobs`
+    :param fileobj: File object opened in binary mode, e.g. stdout
+    :param compression str: None, 'gzip' or 'zstd'
+    :param exclude tuple: Relative paths of the job not added
+    :return: sha1 of the data written
+    """
+    writer = HashWriter(fileobj)
+    stream = _compressor(writer, compression)
+    tar = tarfile.open(fileobj=stream, mode='w|', format=tarfile.GNU_FORMAT)
+    try:
+        for src, relpath in job.copies:
+            tar.add(src, arcname=relpath)
+        for relpath, content in job.contents.items():
+            if relpath in exclude:
+                continue
+            info = tarfile.TarInfo(relpath.replace(os.sep, '/'))
+            info.size = len(content)
+            info.mode = 0o755 if relpath in job.executables else 0o644
+            tar.addfile(info, io.BytesIO(content))
+    finally:
+        tar.close()
+        if stream is not writer:
+            stream.close()
+    writer.flush()
+    return writer.hexdigest()
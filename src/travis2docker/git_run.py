@@ -1,12 +1,25 @@
-
-from __future__ import print_function
-
+import json
 import os
 import re
+import shutil
 import subprocess
+import tempfile
+import threading
+import time
+
+from . import timing
+from .cache import replace
+from .lock import FileLock
+
+RE_SHA = re.compile(r'^[0-9a-f]{40}$')
+# Key of the fetch times for the fetch of all the revisions
+FETCH_ALL = '*'
 
 
 def decode_utf(field):
+    if not isinstance(field, bytes):
+        # Already decoded by `GitRun.run`
+        return field
     try:
         return field.decode('utf-8')
     except UnicodeDecodeError:
@@ -15,11 +28,25 @@ def decode_utf(field):
 
 class GitRun(object):
 
-    def __init__(self, repo_git, path, path_prefix_repo=False):
+    def __init__(self, repo_git, path, path_prefix_repo=False,
+                 partial=False, depth=None):
+        """
+        :param repo_git str: URL or local path of the repository
+        :param path str: Path of the bare repository used as cache
+        :param path_prefix_repo bool: Use a directory named as the URL
+            into `path` for the cache
+        :param partial bool: Clone without blobs. The blobs are fetched
+            only when they are read, e.g. by `show_file`
+        :param depth int: Limit the history cloned and fetched to this
+            number of commits
+        """
         self.repo_git = repo_git
+        self.partial = partial
+        self.depth = depth
         if path_prefix_repo:
             path = os.path.join(path, self.url2dirname(repo_git))
         self.path = path
+        self.fetch_times_path = os.path.join(path, 't2d-fetch-times.json')
         repo_git_sub = repo_git.replace(':', '/')
         repo_git_sub = re.sub('.+@', '', repo_git_sub)
         repo_git_sub = re.sub('.git$', '', repo_git_sub)
@@ -35,6 +62,25 @@ class GitRun(object):
             self.repo = os.path.basename(os.path.dirname(repo_git))
         else:
             self.host, self.owner, self.repo = False, False, False
+        self._batches = {}
+        self._batch_lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        """Stop the `git cat-file` processes started by `cat_file`"""
+        with self._batch_lock:
+            for process in self._batches.values():
+                try:
+                    process.stdin.close()
+                except (IOError, OSError):
+                    pass
+                process.wait()
+            self._batches.clear()
 
     @staticmethod
     def url2dirname(url):
@@ -56,13 +102,15 @@ class GitRun(object):
     def run(self, cmd):
         """Execute git command in bash"""
         cmd = ['git', '--git-dir=%s' % self.path] + cmd
-        print("cmd list", cmd)
-        print("cmd", ' '.join(cmd))
         res = None
-        try:
-            res = subprocess.check_output(cmd)
-        except BaseException:
-            pass
+        with timing.span('git ' + cmd[2], 'git', cmd=cmd) as args:
+            try:
+                res = subprocess.check_output(cmd)
+                args['returncode'] = 0
+            except subprocess.CalledProcessError as error:
+                args['returncode'] = error.returncode
+            except BaseException:
+                args['returncode'] = None
         if res:
             try:
                 res = res.decode()
@@ -92,23 +140,243 @@ class GitRun(object):
             res[subres.pop('refname')] = subres
         return res
 
-    def update(self):
-        """Get a repository git or update it"""
+    @staticmethod
+    def is_sha(revision):
+        return bool(RE_SHA.match(revision))
+
+    @classmethod
+    def revision2refspec(cls, revision):
+        """Get the refspec to fetch just a branch, a pull request or a sha
+        e.g. 'pull/1' -> '+refs/pull/1/head:refs/pull/1'
+        """
+        if cls.is_sha(revision):
+            return revision
+        if revision.startswith('pull/'):
+            return '+refs/%s/head:refs/%s' % (revision, revision)
+        return '+refs/heads/%s:refs/heads/%s' % (revision, revision)
+
+    def update(self, revision=None):
+        """Get a repository git or update it
+
+        The clone, gc and fetch are done holding a lock of the repository,
+        so many processes can share the same cache. If other process
+        fetched the same revisions while this one was waiting the lock,
+        they are not fetched again.
+
+        :param revision: Fetch just this branch, pull request or sha.
+            It could be a list to fetch many of them at once.
+            Default: Fetch all the branches and pull requests.
+        """
+        # The cat-file processes could not see the objects fetched
+        self.close()
+        if revision is None:
+            revisions = [FETCH_ALL]
+        else:
+            revisions = list(revision) \
+                if isinstance(revision, (list, tuple)) else [revision]
+        fetch_times = self.get_fetch_times()
+        with timing.span('git update', 'git', revisions=revisions), \
+                FileLock(self.path + '.lock'):
+            new_fetch_times = self.get_fetch_times()
+            if new_fetch_times.get(FETCH_ALL) != fetch_times.get(FETCH_ALL):
+                return
+            revisions = [rev for rev in revisions
+                         if new_fetch_times.get(rev) == fetch_times.get(rev)]
+            if not revisions:
+                return
+            self._update(revisions)
+
+    def _update(self, revisions):
         if not os.path.isdir(os.path.join(self.path)):
             os.makedirs(self.path)
         if not os.path.isdir(os.path.join(self.path, 'refs')):
-            subprocess.check_output([
-                'git', 'clone', '--bare', self.repo_git, self.path
-            ])
-        self.run(['gc', '--auto', '--prune=all'])
-        self.run(['fetch', '-p', 'origin', '+refs/heads/*:refs/heads/*'])
-        self.run(['fetch', '-p', 'origin', '+refs/pull/*/head:refs/pull/*'])
+            self.clone()
+        fetch = ['fetch', '-p']
+        if self.depth:
+            fetch.append('--depth=%d' % self.depth)
+        fetch.append('origin')
+        fetch_time = time.time()
+        if revisions == [FETCH_ALL]:
+            self.run(['gc', '--auto', '--prune=all'])
+            res_heads = self.run(fetch + ['+refs/heads/*:refs/heads/*'])
+            res_pulls = self.run(fetch + ['+refs/pull/*/head:refs/pull/*'])
+            if res_heads is None or res_pulls is None:
+                revisions = []
+        else:
+            res = self.run(
+                fetch + [self.revision2refspec(rev) for rev in revisions])
+            if res is None and len(revisions) > 1:
+                # A missing revision fails the fetch of all of them
+                revisions = [
+                    rev for rev in revisions
+                    if self.run(fetch + [self.revision2refspec(rev)])
+                    is not None]
+            elif res is None:
+                revisions = []
+        # Just the revisions fetched are updated
+        if revisions:
+            self.save_fetch_time(revisions, fetch_time)
+
+    def get_fetch_times(self):
+        """Get the time of the last fetch of each revision.
+        The key '*' is the last fetch of all the revisions."""
+        try:
+            with open(self.fetch_times_path) as f_times:
+                return json.load(f_times)
+        except (IOError, OSError, ValueError):
+            return {}
+
+    def save_fetch_time(self, revisions, fetch_time):
+        fetch_times = self.get_fetch_times()
+        for revision in revisions:
+            fetch_times[revision] = fetch_time
+        tmp_path = self.fetch_times_path + '.tmp'
+        with open(tmp_path, 'w') as f_times:
+            json.dump(fetch_times, f_times, indent=1, sort_keys=True)
+        replace(tmp_path, self.fetch_times_path)
+
+    def is_updated(self, revision, ttl=0):
+        """Check if the revision can be used without fetching it
+
+        A sha is updated if it is in the local repository. A branch or
+        pull request is updated if it was fetched (alone or with all the
+        revisions) less than `ttl` seconds ago.
+
+        :param revision str: Branch, pull request e.g. 'pull/1' or sha
+        :param ttl int: Seconds that a fetch of a revision is valid
+        """
+        if not os.path.isdir(os.path.join(self.path, 'refs')):
+            return False
+        if self.is_sha(revision):
+            return self.object_exists(revision + '^{commit}')
+        fetch_times = self.get_fetch_times()
+        last_fetch = max(fetch_times.get(revision, 0),
+                         fetch_times.get(FETCH_ALL, 0))
+        return time.time() - last_fetch < ttl and \
+            self.object_exists(revision)
+
+    def clone(self):
+        """Clone the bare repository used as cache"""
+        cmd = ['git', 'clone', '--bare']
+        repo_git = self.repo_git
+        if self.partial:
+            cmd.append('--filter=blob:none')
+        if self.depth:
+            cmd.append('--depth=%d' % self.depth)
+        if (self.partial or self.depth) and os.path.isdir(repo_git):
+            # A local clone ignores the filter and the depth
+            repo_git = 'file://' + os.path.abspath(repo_git)
+        cmd += [repo_git, self.path]
+        with timing.span('git clone', 'git', cmd=cmd) as args:
+            try:
+                subprocess.check_output(cmd)
+            except subprocess.CalledProcessError as error:
+                args['returncode'] = error.returncode
+                raise
+            args['returncode'] = 0
+
+    def bundle(self, revision, bundle_path):
+        """Write a git bundle with the history of a revision already fetched
+
+        The bundle has just the ref fetched by the Dockerfile for the
+        revision, e.g. refs/pull/1/head, or a ref of the sha. It is
+        created from a temporary repository borrowing the objects of the
+        cache, so the refs of the cache are not changed.
+
+        :param revision str: Branch, pull request e.g. 'pull/1' or sha
+        :param bundle_path str: Path of the bundle written
+        :return: Sha of the revision bundled
+        """
+        sha = self.get_sha(revision)
+        if not sha:
+            raise UserWarning("The revision %s was not fetched" % revision)
+        ref = self.revision2refspec(revision).split(':')[0].lstrip('+')
+        if ref == revision:
+            ref = 'refs/t2d/bundle'
+        tmp_path = tempfile.mkdtemp(prefix='t2d-bundle-')
+        try:
+            bundle_git = GitRun(self.repo_git, tmp_path)
+            bundle_git.run(['init', '--bare', '-q'])
+            with open(os.path.join(tmp_path, 'objects', 'info', 'alternates'),
+                      'w') as f_alternates:
+                f_alternates.write(
+                    os.path.join(os.path.abspath(self.path), 'objects') +
+                    '\n')
+            bundle_git.run(['update-ref', ref, sha])
+            if bundle_git.run(['bundle', 'create', bundle_path + '.tmp',
+                               ref]) is None:
+                raise UserWarning(
+                    "The bundle of %s could not be created" % revision)
+        finally:
+            shutil.rmtree(tmp_path)
+        replace(bundle_path + '.tmp', bundle_path)
+        return sha
+
+    def _batch_process(self, option):
+        process = self._batches.get(option)
+        if process is None or process.poll() is not None:
+            process = subprocess.Popen(
+                ['git', '--git-dir=%s' % self.path, 'cat-file', option],
+                stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+            self._batches[option] = process
+        return process
+
+    def cat_file(self, obj, option='--batch'):
+        """Query an object to a long-lived `git cat-file` process.
+        The process is started the first time and it is reused for next
+        queries with the same option until `close` is called.
+
+        :param obj str: Object to query e.g. "master" or "sha:.travis.yml"
+        :param option str: '--batch' to get the content of the object
+            or '--batch-check' to get only its information
+        :return: tuple (sha, type, content) or None if the object is
+            missing. The content is None with '--batch-check'.
+        :raise: IOError or OSError if the process is not working
+        """
+        with self._batch_lock:
+            process = self._batch_process(option)
+            process.stdin.write(obj.encode('utf-8') + b'\n')
+            process.stdin.flush()
+            header = process.stdout.readline().decode('utf-8').split()
+            if not header:
+                raise IOError("git cat-file %s finished: %s" % (
+                    option, process.poll()))
+            if len(header) != 3:
+                # "<obj> missing" or "<obj> ambiguous"
+                return None
+            sha, obj_type, size = header
+            content = None
+            if option == '--batch':
+                content = process.stdout.read(int(size))
+                # Each content ends with a newline
+                process.stdout.read(1)
+            return sha, obj_type, content
+
+    def _cat_file(self, obj, option='--batch'):
+        """Like `cat_file` but return False if the process is not working"""
+        try:
+            return self.cat_file(obj, option)
+        except (IOError, OSError, ValueError):
+            self.close()
+            return False
+
+    def object_exists(self, obj):
+        """Check if an object or revision is in the local repository"""
+        result = self._cat_file(obj, '--batch-check')
+        if result is False:
+            return self.run(['cat-file', '-e', obj]) is not None
+        return result is not None
 
     def show_file(self, git_file, sha):
-        result = self.run(["show", "%s:%s" % (sha, git_file)])
-        return result
+        result = self._cat_file("%s:%s" % (sha, git_file))
+        if result is False:
+            return self.run(["show", "%s:%s" % (sha, git_file)])
+        return result and result[2].decode('utf-8')
 
     def get_sha(self, revision):
+        result = self._cat_file(revision, '--batch-check')
+        if result is not False:
+            return result and result[0]
         result = self.run(["rev-parse", revision])
         return result \
             if isinstance(result, list) \
@@ -0,0 +1,60 @@
+"""Locks of files shared by many processes, e.g. the cache of a repository
+used by several invocations of travis2docker with the same root path."""
+import os
+import time
+
+from .cache import mkdir_p
+
+try:
+    import fcntl
+except ImportError:
+    # Windows
+    fcntl = None
+    import msvcrt
+
+
+class FileLock(object):
+    """Exclusive lock of a file between processes and threads.
+
+    Use it as a context manager::
+
+        with FileLock('/tmp/repo.lock'):
+            ...
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._fd = None
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+    def acquire(self):
+        """Wait until the lock is free and take it"""
+        mkdir_p(os.path.dirname(self.path))
+        self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        if fcntl is not None:
+            fcntl.flock(self._fd, fcntl.LOCK_EX)
+            return
+        while True:
+            try:
+                msvcrt.locking(self._fd, msvcrt.LK_LOCK, 1)
+                return
+            except (IOError, OSError):
+                # LK_LOCK gives up after 10 seconds
+                time.sleep(1)
+
+    def release(self):
+        if self._fd is None:
+            return
+        if fcntl is not None:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+        else:
+            os.lseek(self._fd, 0, os.SEEK_SET)
+            msvcrt.locking(self._fd, msvcrt.LK_UNLCK, 1)
+        os.close(self._fd)
+        self._fd = None
@@ -0,0 +1,218 @@
+"""
+Command line app to build and run the jobs generated in parallel.
+
+Each job runs its `10-build.sh` and `20-run.sh` without a TTY, so many of
+them run unattended at the same time. The output of each job is saved in
+its own log and a summary with the exit codes and durations is written as
+JSON and optionally as JUnit XML.
+"""
+import argparse
+import json
+import os
+import re
+import subprocess
+import sys
+import time
+from multiprocessing.pool import ThreadPool
+from xml.etree import ElementTree
+
+from .cache import mkdir_p
+
+# Memory in bytes reserved for each job to compute the default workers
+MEMORY_PER_JOB = 2 * 1024 ** 3
+
+
+def get_workers(memory_per_job=MEMORY_PER_JOB):
+    """Get the number of jobs to run at the same time limited by the CPUs
+    and the physical memory"""
+    try:
+        import multiprocessing
+        workers = multiprocessing.cpu_count()
+    except NotImplementedError:
+        workers = 1
+    try:
+        memory = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+    except (AttributeError, ValueError, OSError):
+        # e.g. Windows
+        memory = None
+    if memory and memory_per_job:
+        workers = min(workers, memory // memory_per_job)
+    return max(int(workers), 1)
+
+
+def get_job_name(work_path, root_path):
+    """Get a name of the job unique between the work paths run"""
+    relpath = os.path.relpath(work_path, root_path)
+    if relpath == os.curdir:
+        relpath = os.path.basename(work_path)
+    return re.sub(r'[^\w.-]+', '_', relpath).strip('_')
+
+
+def run_script(script, log_file, args=None, env=None):
+    """Run a script of a job appending its output to the log
+
+    :return: tuple (exit code, duration in seconds)
+    """
+    log_file.write(('$ %s\n' % ' '.join([script] + (args or []))).encode(
+        'utf-8'))
+    log_file.flush()
+    start = time.time()
+    try:
+        with open(os.devnull) as devnull:
+            returncode = subprocess.call(
+                ['bash', script] + (args or []), stdout=log_file,
+                stderr=subprocess.STDOUT, stdin=devnull, env=env)
+    except OSError as error:
+        log_file.write(('%s\n' % error).encode('utf-8'))
+        returncode = 127
+    return returncode, time.time() - start
+
+
+def run_job(work_path, log_path, build=True, run_args=None):
+    """Build and run a job
+
+    :param work_path str: Path of the job generated
+    :param log_path str: Path of the log with the output of the job
+    :param build bool: Build the image before running it
+    :param run_args list: Extra arguments of `docker run`
+    :return: dict with the result of the job
+    """
+    env = dict(os.environ, T2D_RUN_TTY_ARGS='')
+    result = {
+        'work_path': work_path,
+        'log': log_path,
+        'build_returncode': None,
+        'build_duration': 0.0,
+        'returncode': None,
+        'duration': 0.0,
+    }
+    with open(log_path, 'wb') as log_file:
+        if build:
+            result['build_returncode'], result['build_duration'] = \
+                run_script(os.path.join(work_path, '10-build.sh'), log_file,
+                           env=env)
+            if result['build_returncode']:
+                result['status'] = 'build_failed'
+                return result
+        run_cmd_args = [' '.join(run_args)] if run_args else []
+        result['returncode'], result['duration'] = run_script(
+            os.path.join(work_path, '20-run.sh'), log_file, run_cmd_args,
+            env=env)
+    result['status'] = 'failed' if result['returncode'] else 'passed'
+    return result
+
+
+def run_jobs(work_paths, logs_path, workers=None, build=True,
+             run_args=None):
+    """Build and run the jobs in parallel
+
+    :param work_paths list: Paths of the jobs e.g. of `compute_dockerfile`
+    :param logs_path str: Directory of the logs of the jobs
+    :param workers int: Jobs running at the same time.
+        Default: `get_workers`
+    :return: dict with the result of every job in the same order
+    """
+    mkdir_p(logs_path)
+    root_path = os.path.commonprefix(work_paths)
+    if not root_path.endswith(os.sep):
+        root_path = os.path.dirname(root_path)
+    names = [get_job_name(work_path, root_path) for work_path in work_paths]
+
+    def run(index):
+        result = run_job(
+            work_paths[index],
+            os.path.join(logs_path, names[index] + '.log'),
+            build=build, run_args=run_args)
+        result['name'] = names[index]
+        return result
+    pool = ThreadPool(max(min(workers or get_workers(), len(work_paths)), 1))
+    try:
+        results = pool.map(run, range(len(work_paths)))
+    finally:
+        pool.close()
+        pool.join()
+    return {
+        'jobs': results,
+        'failures': len([result for result in results
+                         if result['status'] != 'passed']),
+    }
+
+
+def junit_xml(summary):
+    """Get the summary as a JUnit XML report with a test case by job"""
+    suite = ElementTree.Element('testsuite', {
+        'name': 'travis2docker',
+        'tests': str(len(summary['jobs'])),
+        'failures': str(summary['failures']),
+        'time': '%.3f' % sum(job['build_duration'] + job['duration']
+                             for job in summary['jobs']),
+    })
+    for job in summary['jobs']:
+        case = ElementTree.SubElement(suite, 'testcase', {
+            'classname': 'travis2docker',
+            'name': job['name'],
+            'time': '%.3f' % (job['build_duration'] + job['duration']),
+        })
+        if job['status'] == 'passed':
+            continue
+        if job['status'] == 'build_failed':
+            message = "Build failed with exit code %s" % (
+                job['build_returncode'])
+        else:
+            message = "Run failed with exit code %s" % job['returncode']
+        failure = ElementTree.SubElement(case, 'failure', {
+            'message': message, 'type': job['status']})
+        failure.text = "Log: %s" % job['log']
+    return ElementTree.tostring(suite, encoding='utf-8')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Build and run in parallel the jobs generated by "
+                    "travisfile2dockerfile.",
+    )
+    parser.add_argument(
+        'work_paths', nargs='+',
+        help="Paths of the jobs generated, e.g. the output of "
+             "travisfile2dockerfile.",
+    )
+    parser.add_argument(
+        '--workers', dest='workers', type=int,
+        help="Jobs built and run at the same time."
+             "\nDefault: The CPUs, limited by the memory with 2 GiB by job",
+    )
+    parser.add_argument(
+        '--no-build', dest='build', action='store_false', default=True,
+        help="Run the images already built without building them again.",
+    )
+    parser.add_argument(
+        '--run-args', dest='run_args', action='append',
+        help="Extra argument of `docker run`, e.g. --run-args=--rm",
+    )
+    parser.add_argument(
+        '--logs-path', dest='logs_path', default='t2d-logs',
+        help="Directory of the logs of the jobs."
+             "\nDefault: t2d-logs",
+    )
+    parser.add_argument(
+        '--summary', dest='summary', default='-',
+        help="Path of the JSON summary of the exit codes and durations."
+             "\nDefault: stdout",
+    )
+    parser.add_argument(
+        '--junit', dest='junit',
+        help="Path of a JUnit XML report of the jobs.",
+    )
+    args = parser.parse_args(argv)
+    summary = run_jobs(args.work_paths, args.logs_path, args.workers,
+                       build=args.build, run_args=args.run_args)
+    content = json.dumps(summary, indent=1, sort_keys=True) + '\n'
+    if args.summary == '-':
+        sys.stdout.write(content)
+    else:
+        with open(args.summary, 'w') as f_summary:
+            f_summary.write(content)
+    if args.junit:
+        with open(args.junit, 'wb') as f_junit:
+            f_junit.write(junit_xml(summary))
+    return 1 if summary['failures'] else 0
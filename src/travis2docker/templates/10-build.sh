@@ -1,4 +1,5 @@
 #!/bin/bash
 export IMAGE={{ image }}
-docker build {{ extra_params }} $1 -t $IMAGE {{ dirname_dockerfile }}
+{% if buildkit %}export DOCKER_BUILDKIT=1
+{% endif %}docker build {{ extra_params }} $1 -t $IMAGE {% if context_tar %}- < {{ context_tar }}{% else %}{{ dirname_dockerfile }}{% endif %}
 {{ extra_cmds }}
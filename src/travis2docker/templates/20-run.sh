@@ -1,4 +1,4 @@
 #!/bin/bash
 export IMAGE={{ image }}
-docker run {{ extra_params }} $1 -itP $IMAGE $2
+docker run {{ extra_params }}{% for volume, path in volumes %} -v {{ volume }}:{{ path }}{% endfor %} $1 ${T2D_RUN_TTY_ARGS--itP} $IMAGE $2
 {{ extra_cmds }}
@@ -0,0 +1,16 @@
+group "default" {
+  targets = [{% for job in jobs %}{{ ('job-%d' % job.count) | hcl }}{% if not loop.last %}, {% endif %}{% endfor %}]
+}
+{% for job in jobs %}
+target {{ ('job-%d' % job.count) | hcl }} {
+  context = {{ job.work_path | hcl }}
+  dockerfile = {{ dockerfile | hcl }}
+  tags = [{{ job.image | hcl }}]
+{%- if cache_from %}
+  cache-from = [{{ cache_from | map('hcl') | join(', ') }}]
+{%- endif %}
+{%- if cache_to %}
+  cache-to = [{{ cache_to | map('hcl') | join(', ') }}]
+{%- endif %}
+}
+{% endfor %}
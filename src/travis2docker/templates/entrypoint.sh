@@ -3,6 +3,21 @@
 source /home/travis/virtualenv/python2.7_with_system_site_packages/bin/activate
 {%- endif %}
 source /rvm_env.sh
+{% if run_caches -%}
+# The caches are copied from their volumes at start and back at exit
+# with a lock, so the containers running at the same time do not share
+# a directory being written
+{% for path, directory in run_caches -%}
+mkdir -p {{ path }}/data {{ directory }}
+(flock -s 9; cp -au {{ path }}/data/. {{ directory }}/) 9>{{ path }}/lock
+{% endfor -%}
+save_caches() {
+{%- for path, directory in run_caches %}
+    (flock 9; cp -au {{ directory }}/. {{ path }}/data/) 9>{{ path }}/lock
+{%- endfor %}
+}
+trap save_caches EXIT
+{% endif -%}
 {% for entrypoint in entrypoints %}
 {{ entrypoint }}
 {% endfor %}
@@ -0,0 +1,124 @@
+"""Jinja environments of the templates shared by the instances of a process.
+
+The bundled templates are loaded from python modules precompiled by
+`compile_templates` at build time, if they are up to date. Other templates
+are parsed once per process and their bytecode is cached on disk, so new
+processes skip the lexing and the compilation too.
+"""
+import hashlib
+import json
+import os
+import threading
+
+import jinja2
+
+from .cache import mkdir_p
+
+TEMPLATES_PATH = os.path.join(
+    os.path.dirname(os.path.realpath(__file__)), 'templates')
+
+COMPILED_TEMPLATES_PATH = os.path.join(
+    os.path.dirname(os.path.realpath(__file__)), 'templates_compiled')
+
+COMPILED_STAMP_NAME = 'stamp.json'
+
+_jinja_envs = {}
+_jinja_envs_lock = threading.Lock()
+
+
+def hcl_string(value):
+    """Quote a value as a string of HCL, e.g. for docker-bake.hcl"""
+    return json.dumps(str(value)).replace('${', '$${').replace('%{', '%%{')
+
+
+def new_environment(loader, **kwargs):
+    """Create a jinja environment with the filters used by the templates"""
+    env = jinja2.Environment(loader=loader, **kwargs)
+    env.filters['hcl'] = hcl_string
+    return env
+
+
+def digest_templates(templates_path):
+    """Hash the names and the content of the templates
+
+    The permissions are not part of the hash because they depend on the
+    umask of the checkout built and of the install.
+    """
+    sha = hashlib.sha1()
+    for root, dirnames, fnames in os.walk(templates_path):
+        dirnames.sort()
+        for fname in sorted(fnames):
+            fpath = os.path.join(root, fname)
+            sha.update(('%s\0' % os.path.relpath(
+                fpath, templates_path)).encode('utf-8'))
+            with open(fpath, 'rb') as f_template:
+                sha.update(f_template.read())
+            sha.update(b'\0')
+    return sha.hexdigest()
+
+
+def get_stamp(templates_path):
+    """Get the data identifying a compilation of the templates"""
+    return {
+        'digest': digest_templates(templates_path),
+        'jinja2': jinja2.__version__,
+    }
+
+
+def compile_templates(templates_path, target):
+    """Compile the templates of a directory into python modules loaded by
+    `jinja2.ModuleLoader`
+
+    :param templates_path str: Directory of the templates
+    :param target str: Directory of the modules compiled
+    """
+    env = new_environment(jinja2.FileSystemLoader(templates_path))
+    env.compile_templates(target, zip=None, ignore_errors=False)
+    with open(os.path.join(target, COMPILED_STAMP_NAME), 'w') as f_stamp:
+        json.dump(get_stamp(templates_path), f_stamp)
+
+
+def is_compiled(templates_path, compiled_path):
+    """Check the modules of `compiled_path` were compiled from the current
+    templates and with the jinja2 version installed"""
+    try:
+        with open(os.path.join(compiled_path, COMPILED_STAMP_NAME)) as f_stamp:
+            stamp = json.load(f_stamp)
+    except (IOError, OSError, ValueError):
+        return False
+    return stamp == get_stamp(templates_path)
+
+
+def get_jinja_env(templates_path=None, cache_path=None):
+    """Get the environment of the templates created once per process
+
+    :param templates_path str: Directory of the templates.
+        Default: The templates bundled
+    :param cache_path str: Optional directory of the bytecode cache of the
+        templates. The templates changed are compiled again because the
+        checksum of their source is part of the key.
+    :return: `jinja2.Environment`
+    """
+    if templates_path is None:
+        templates_path = TEMPLATES_PATH
+    key = (templates_path, cache_path)
+    with _jinja_envs_lock:
+        if key in _jinja_envs:
+            return _jinja_envs[key]
+        bytecode_cache = None
+        if templates_path == TEMPLATES_PATH and \
+                is_compiled(templates_path, COMPILED_TEMPLATES_PATH):
+            loader = jinja2.ModuleLoader(COMPILED_TEMPLATES_PATH)
+        else:
+            loader = jinja2.FileSystemLoader(templates_path)
+            if cache_path:
+                try:
+                    mkdir_p(cache_path)
+                    bytecode_cache = jinja2.FileSystemBytecodeCache(
+                        cache_path)
+                except OSError:
+                    # The templates are compiled without the cache
+                    pass
+        env = new_environment(loader, bytecode_cache=bytecode_cache)
+        _jinja_envs[key] = env
+        return env
@@ -0,0 +1,127 @@
+"""Instrumentation of the time spent by the phases of a run.
+
+The phases are recorded with `span` only while a `Recorder` is enabled, so
+the cost is negligible by default::
+
+    recorder = timing.enable()
+    with timing.span('load_yml'):
+        ...
+    sys.stderr.write(recorder.format_table())
+    recorder.write_trace('trace.json')
+"""
+import contextlib
+import json
+import os
+import threading
+import time
+
+timer = getattr(time, 'perf_counter', time.time)
+
+_recorder = None
+
+
+class Recorder(object):
+    """Events of the phases with their start, duration and arguments"""
+
+    def __init__(self):
+        self.events = []
+        self.start = timer()
+        self._lock = threading.Lock()
+
+    def add(self, name, category, start, duration, args=None):
+        """Record a phase
+
+        :param name str: Name of the phase e.g. 'git fetch'
+        :param category str: Group of the phase e.g. 'git', 'render'
+        :param start float: Start of the phase returned by `timer`
+        :param duration float: Seconds spent
+        :param args dict: Optional data of the phase e.g. the exit status
+        """
+        event = {
+            'name': name,
+            'cat': category,
+            'start': start - self.start,
+            'duration': duration,
+            'tid': threading.current_thread().ident,
+            'args': args or {},
+        }
+        with self._lock:
+            self.events.append(event)
+
+    def summary(self):
+        """Aggregate the events by phase
+
+        :return: List of tuples (category, name, count, total seconds,
+            maximum seconds) sorted by the total descending
+        """
+        phases = {}
+        for event in self.events:
+            key = (event['cat'], event['name'])
+            count, total, maximum = phases.get(key, (0, 0, 0))
+            phases[key] = (count + 1, total + event['duration'],
+                           max(maximum, event['duration']))
+        return sorted((key + value for key, value in phases.items()),
+                      key=lambda phase: (-phase[3], phase[0], phase[1]))
+
+    def format_table(self):
+        """Get the summary as a table of text"""
+        lines = ['%-10s %-30s %6s %10s %10s' % (
+            'Category', 'Phase', 'Count', 'Total(s)', 'Max(s)')]
+        for category, name, count, total, maximum in self.summary():
+            lines.append('%-10s %-30s %6d %10.3f %10.3f' % (
+                category, name, count, total, maximum))
+        return '\n'.join(lines) + '\n'
+
+    def trace(self):
+        """Get the events in the Chrome trace event format supported by
+        chrome://tracing, Perfetto or speedscope"""
+        pid = os.getpid()
+        return {
+            'traceEvents': [{
+                'name': event['name'],
+                'cat': event['cat'],
+                'ph': 'X',
+                'ts': int(event['start'] * 1e6),
+                'dur': int(event['duration'] * 1e6),
+                'pid': pid,
+                'tid': event['tid'],
+                'args': event['args'],
+            } for event in self.events],
+            'displayTimeUnit': 'ms',
+        }
+
+    def write_trace(self, path):
+        with open(path, 'w') as f_trace:
+            json.dump(self.trace(), f_trace)
+
+
+def enable():
+    """Start recording the phases of this process
+
+    :return: The `Recorder` enabled
+    """
+    global _recorder
+    _recorder = Recorder()
+    return _recorder
+
+
+def disable():
+    global _recorder
+    _recorder = None
+
+
+@contextlib.contextmanager
+def span(name, category='phase', **args):
+    """Record the time spent in the block if a recorder is enabled.
+    The dict yielded could be updated with more arguments of the phase
+    e.g. the exit status of a command.
+    """
+    recorder = _recorder
+    if recorder is None:
+        yield args
+        return
+    start = timer()
+    try:
+        yield args
+    finally:
+        recorder.add(name, category, start, timer() - start, args)
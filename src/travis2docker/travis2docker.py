@@ -1,27 +1,283 @@
 import collections
-import errno
+import functools
+import hashlib
 import json
 import os
 import re
 import shutil
 import stat
+import threading
+from multiprocessing.pool import ThreadPool
 from tempfile import gettempdir
 
-import jinja2
 import yaml
 
+from . import timing
+from .cache import DiskCache
+from .cache import PathStore
+from .cache import digest_path
+from .cache import link_path
+from .cache import mkdir_p
+from .cache import read_marshal
+from .cache import replace
+from .cache import write_marshal
+from .context import CONTEXT_NAMES
+from .context import write_context
+from .templating import get_jinja_env
+
 RE_ENV_STR = r"(?P<var>[\w]*)[ ]*[\=][ ]*[\"\']{0,1}" + \
              r"(?P<value>[\w\.\-\_/\$\{\}\:,\(\)\#\* ]*)[\"\']{0,1}"
 RE_EXPORT_STR = r"^(?P<export>export|EXPORT)( )+" + RE_ENV_STR
 
+MANIFEST_NAME = '.t2d-manifest.json'
+
+# File of `docker buildx bake` with all the jobs
+BAKE_NAME = 'docker-bake.hcl'
+
+# Scripts of a job out of its build context
+BUILD_SCRIPTS = ('10-build.sh', '20-run.sh')
+
+# Directories of the caches of `cache:` enabled by name, e.g. `cache: pip`
+CACHE_DIRECTORIES = {
+    'pip': '$HOME/.cache/pip',
+    'npm': '$HOME/.npm',
+    'ccache': '$HOME/.ccache',
+    'cargo': '$HOME/.cargo',
+}
+
+# Caches of downloads only, mounted by BuildKit. The content of a cache
+# mount is not in the image, so e.g. ~/.cargo with the toolchain is not
+DOWNLOAD_CACHE_DIRECTORIES = ('$HOME/.cache/pip', '$HOME/.npm',
+                              '$HOME/.ccache')
+
+# Directory of the archives downloaded by apt. The lists are kept in the
+# image for the `apt-get install` of the scripts
+APT_CACHE_DIRECTORIES = ('/var/cache/apt',)
+
+# Directory of the volumes of the caches in the containers
+RUN_CACHES_PATH = '/t2d-cache'
+
+# Path of the git bundle of the revision in the image
+GIT_BUNDLE_PATH = '/t2d.bundle'
+
+APT_SOURCES_PATH = os.path.join(
+    os.path.dirname(os.path.realpath(__file__)),
+    'travis-ci-apt-source-whitelist', 'ubuntu.json')
+
+_apt_sources = {}
+_apt_sources_lock = threading.Lock()
+
+
+def get_apt_sources(json_path=None, cache_path=None):
+    """Get the whitelist of apt sources indexed by alias
+
+    The whitelist is parsed once per process and shared by all the
+    instances of `Travis2Docker`.
+
+    :param json_path str: Path of the whitelist. Default: ubuntu.json
+        of travis-ci-apt-source-whitelist
+    :param cache_path str: Optional directory to save a marshal cache of
+        the index. It is invalidated when the mtime of the json changes.
+    :return: dict {alias: [source, ...]}
+    """
+    if json_path is None:
+        json_path = APT_SOURCES_PATH
+    with _apt_sources_lock:
+        if json_path in _apt_sources:
+            return _apt_sources[json_path]
+        mtime = os.stat(json_path).st_mtime
+        cache_file = cache_path and os.path.join(
+            cache_path, 'apt-sources-%s.marshal' %
+            hashlib.sha1(json_path.encode('utf-8')).hexdigest())
+        cached = cache_file and read_marshal(cache_file)
+        if cached and cached.get('mtime') == mtime:
+            index = cached['index']
+        else:
+            index = {}
+            with open(json_path) as f_json:
+                for source in json.load(f_json):
+                    index.setdefault(source['alias'], []).append(source)
+            if cache_file:
+                write_marshal(cache_file, {'mtime': mtime, 'index': index})
+        _apt_sources[json_path] = index
+        return index
+
+
+def read_manifest(work_path):
+    """Get the manifest of a job generated by `Travis2Docker`
+
+    :return: dict {relative path: content hash} or None if it is missing
+    """
+    try:
+        with open(os.path.join(work_path, MANIFEST_NAME)) as f_manifest:
+            return json.load(f_manifest)
+    except (IOError, OSError, ValueError):
+        return None
+
+
+def get_bake_digest(work_path):
+    """Get the sha1 of the docker-bake.hcl of a work path or None if it
+    is missing"""
+    try:
+        with open(os.path.join(work_path, BAKE_NAME), 'rb') as f_bake:
+            return hashlib.sha1(f_bake.read()).hexdigest()
+    except (IOError, OSError):
+        return None
+
+
+def get_stale_jobs(work_path, jobs_count):
+    """Get the jobs generated by a previous run with a bigger matrix
+
+    :param work_path str: Work path of the jobs
+    :param jobs_count int: Jobs of the current matrix
+    :return: dict {job path: manifest}
+    """
+    if not os.path.isdir(work_path):
+        return {}
+    stale_jobs = {}
+    for dirname in os.listdir(work_path):
+        if not dirname.isdigit() or int(dirname) <= jobs_count:
+            continue
+        job_path = os.path.join(work_path, dirname)
+        # Just the directories with a manifest were generated
+        manifest = read_manifest(job_path)
+        if manifest is not None:
+            stale_jobs[job_path] = manifest
+    return stale_jobs
+
+
+def check_manifest(work_path, manifest):
+    """Check that a job was not changed since it was generated
+
+    :param work_path str: Path of the job
+    :param manifest dict: Manifest of the job when it was generated
+    :return: True if the manifest and every file listed have not changed
+    """
+    if not manifest or read_manifest(work_path) != manifest:
+        return False
+    for relpath, digest in manifest.items():
+        path = os.path.join(work_path, relpath)
+        if not os.path.exists(path):
+            return False
+        if os.path.isfile(path):
+            with open(path, 'rb') as f_generated:
+                if hashlib.sha1(f_generated.read()).hexdigest() == digest:
+                    continue
+        # The digest of a path copied
+        if digest_path(path) != digest:
+            return False
+    return True
+
+
+# Maximum size in bytes of the cache of .travis.yml parsed
+YML_CACHE_SIZE = 16 * 1024 * 1024
+
+
+def load_yml(yml_buffer, cache_path=None):
+    """Parse the content of a .travis.yml
+
+    The libyaml safe loader is used if it is available. The data parsed is
+    cached in `cache_path` with the git blob sha of the content as key, so
+    the same content is never parsed again.
+
+    :param yml_buffer: Content or stream of the .travis.yml
+    :param cache_path str: Optional directory of the cache
+    :return: Data parsed
+    """
+    if hasattr(yml_buffer, 'read'):
+        yml_buffer = yml_buffer.read()
+    content = yml_buffer
+    if not isinstance(content, bytes):
+        content = content.encode('utf-8')
+    yml_cache = cache_path and DiskCache(cache_path, YML_CACHE_SIZE)
+    if yml_cache:
+        blob_sha = hashlib.sha1(
+            b'blob ' + str(len(content)).encode('utf-8') + b'\0' + content
+        ).hexdigest()
+        data = yml_cache.get(blob_sha)
+        if data is not None:
+            return data
+    loader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+    data = yaml.load(yml_buffer, Loader=loader)
+    if yml_cache and data is not None:
+        yml_cache.set(blob_sha, data)
+    return data
+
+
+class Job(object):
+    """State of a single job of the env matrix.
+
+    Each job keeps its own work path and accumulated exports so jobs
+    can be computed independently, even from different threads.
+
+    The artifacts computed by `Travis2Docker.iter_jobs` are kept in memory:
+
+    - `image`: Tag of the image built by the job, shared by the jobs with
+      the same build context
+    - `contents`: {relative path: content bytes} of the files generated
+      e.g. 'Dockerfile', 'files/entrypoint.sh', 'files/script',
+      '10-build.sh' and '20-run.sh'
+    - `executables`: Relative paths of `contents` with execution permission
+    - `copies`: List of tuples (source path, relative path) of the paths
+      copied into the job
+    - `run_caches`: List of tuples (volume path, cache directory) of the
+      caches shared between the containers of the job
+    """
+
+    def __init__(self, count, env, work_path, env_matrix=None):
+        self.count = count
+        self.env = env
+        # Variables of the row of the matrix, without the global ones
+        self.env_matrix = env if env_matrix is None else env_matrix
+        self.work_path = work_path
+        self.exports = []
+        self.image = None
+        self.contents = collections.OrderedDict()
+        self.executables = set()
+        self.copies = []
+        self.run_caches = []
+        # Section scripts equal for many jobs, they are hardlinked
+        self.shared = set()
+        # {relative path: content hash} of the previous and current run
+        self.manifest = {}
+        self.files = {}
+
+    def context_digest(self):
+        """Get the hash of the build context of the job, equal for the
+        jobs building the same image"""
+        sha = hashlib.sha1()
+        for src, relpath in self.copies:
+            sha.update(('%s\0%s\0' % (src, relpath)).encode('utf-8'))
+        for relpath in sorted(self.contents):
+            if relpath in BUILD_SCRIPTS:
+                continue
+            sha.update(('%s\0%s\0' % (
+                relpath, relpath in self.executables)).encode('utf-8'))
+            sha.update(self.contents[relpath])
+        return sha.hexdigest()
+
+    @property
+    def manifest_path(self):
+        return os.path.join(self.work_path, MANIFEST_NAME)
+
+    def add_file(self, relpath, content, executable=False, shared=False):
+        if not isinstance(content, bytes):
+            content = content.encode('utf-8')
+        self.contents[relpath] = content
+        if executable:
+            self.executables.add(relpath)
+        if shared:
+            self.shared.add(relpath)
+
 
 class Travis2Docker(object):
 
     re_export = re.compile(RE_EXPORT_STR, re.M)
+    re_env = re.compile(RE_ENV_STR)
 
     @property
     def dockerfile_template(self):
-        return self.jinja_env.get_template('Dockerfile')
+        return self.get_template('Dockerfile')
 
     @property
     def new_image(self):
@@ -34,37 +290,45 @@ class Travis2Docker(object):
 
     @property
     def entrypoint_template(self):
-        return self.jinja_env.get_template('entrypoint.sh')
+        return self.get_template('entrypoint.sh')
 
     @property
     def build_template(self):
-        return self.jinja_env.get_template('10-build.sh')
+        return self.get_template('10-build.sh')
 
     @property
     def run_template(self):
-        return self.jinja_env.get_template('20-run.sh')
+        return self.get_template('20-run.sh')
+
+    def get_template(self, name):
+        """Get a template of the jinja environment once per instance"""
+        template = self._templates.get(name)
+        if template is None:
+            template = self.jinja_env.get_template(name)
+            self._templates[name] = template
+        return template
+
+    def render(self, name, *args, **kwargs):
+        """Render a template recording the time spent"""
+        with timing.span('render ' + name, 'render'):
+            return self.get_template(name).render(*args, **kwargs)
 
     @staticmethod
     def chmod_execution(file_path):
         os.chmod(file_path, os.stat(file_path).st_mode | stat.S_IEXEC)
 
-    @staticmethod
-    def mkdir_p(path):
-        try:
-            os.makedirs(path)
-        except OSError as os_error:
-            if os_error.errno == errno.EEXIST and os.path.isdir(path):
-                pass
-            else:
-                raise
+    mkdir_p = staticmethod(mkdir_p)
 
     def __init__(self, yml_buffer, image=None, work_path=None, dockerfile=None,
                  templates_path=None, os_kwargs=None, copy_paths=None,
+                 workers=None, cache_path=None, tar_context=False,
+                 tar_compression=None, bake=False, buildkit=False,
+                 run_cache=None, git_bundle=None, shared_install=False,
                  ):
-        self.curr_work_path = None
-        self.curr_exports = []
         self.build_extra_params = {}
         self.run_extra_params = {}
+        # 'cache_from' and 'cache_to' lists of the bake file
+        self.bake_params = {}
         if image is None:
             image = 'vauxoo/odoo-80-image-shippable-auto'
         if os_kwargs is None:
@@ -72,36 +336,54 @@ class Travis2Docker(object):
         os_kwargs.setdefault('user', 'root')
         if dockerfile is None:
             dockerfile = 'Dockerfile'
-        if templates_path is None:
-            templates_path = os.path.join(
-                os.path.dirname(os.path.realpath(__file__)), 'templates')
         self.copy_paths = copy_paths
+        self.workers = workers or 1
+        self._scripts = {}
+        self._scripts_lock = threading.Lock()
+        self._shared_paths = {}
+        self.stats = {}
+        self._stats_lock = threading.Lock()
         self.os_kwargs = os_kwargs
-        self.jinja_env = \
-            jinja2.Environment(loader=jinja2.FileSystemLoader(templates_path))
+        self.jinja_env = get_jinja_env(
+            templates_path, cache_path and os.path.join(cache_path, 'jinja'))
+        self._templates = {}
         self.image = image
         self._sections = collections.OrderedDict()
         self._sections['env'] = 'env'
         self._sections['addons'] = 'addons'
+        self._sections['cache'] = 'cache'
         self._sections['before_install'] = 'run'
         self._sections['install'] = 'run'
         self._sections['script'] = 'entrypoint'
         self._sections['after_success'] = 'entrypoint'
-        self.yml = yaml.load(yml_buffer)
+        with timing.span('load yml', 'yaml'):
+            self.yml = load_yml(
+                yml_buffer, cache_path and os.path.join(cache_path, 'yml'))
         if work_path is None:
             base_name = os.path.splitext(os.path.basename(__file__))[0]
             self.work_path = os.path.join(gettempdir(), base_name)
         else:
             self.work_path = os.path.expandvars(os.path.expanduser(work_path))
         self.dockerfile = dockerfile
+        self.cache_path = cache_path
+        # Write the build context of each job as an archive instead of files
+        self.tar_context = tar_context
+        self.tar_compression = tar_compression
+        # Write a docker-bake.hcl to build all the jobs with buildx
+        self.bake = bake
+        # Use the syntax of BuildKit, e.g. the cache mounts of `cache:`
+        self.buildkit = buildkit
+        # Share the `cache:` directories between the containers of the
+        # repository ('repo') or of each job ('job') with volumes
+        self.run_cache = run_cache
+        # Path of a git bundle of the revision fetched instead of the remote
+        self.git_bundle = git_bundle
+        # Define the variables of the matrix after the install sections
+        # not using them, so the jobs share the layers of the install
+        self.shared_install = shared_install
+        self.store = cache_path and PathStore(os.path.join(cache_path, 'store'))
 
-        travis_ci_apt_src = os.path.join(
-            os.path.dirname(os.path.realpath(__file__)),
-            'travis-ci-apt-source-whitelist')
-        self.ubuntu_json = json.load(
-            open(os.path.join(travis_ci_apt_src, "ubuntu.json")))
-
-    def _compute(self, section):
+    def _compute(self, section, job=None):
         section_type = self._sections.get(section)
         if not section_type:
             return None
@@ -111,10 +393,11 @@ class Travis2Docker(object):
         if not isinstance(section_data, (list, dict, tuple)):
             section_data = [section_data]
         job_method = getattr(self, '_compute_' + section_type)
-        return job_method(section_data, section)
+        with timing.span('compute ' + section, 'compute'):
+            return job_method(section_data, section, job)
 
     @staticmethod
-    def _compute_env(data, _):
+    def _compute_env(data, *_):
         if isinstance(data, list):
             # old version without matrix
             data = {'matrix': data}
@@ -126,93 +409,289 @@ class Travis2Docker(object):
             env_globals += " " + env_global
         env_globals = env_globals.strip()
         for env_matrix in data.get('matrix', []):
-            yield (env_globals + " " + env_matrix).strip()
+            yield env_globals, env_matrix.strip()
 
-    def _compute_run(self, data, section):
-        args = self._make_script(data, section, add_run=True, prefix='files')
+    def _compute_run(self, data, section, job):
+        args = self._make_script(data, section, job, add_run=True,
+                                 prefix='files')
         return args
 
-    def _compute_entrypoint(self, data, section):
-        args = self._make_script(data, section, add_entrypoint=True,
+    def _compute_entrypoint(self, data, section, job):
+        args = self._make_script(data, section, job, add_entrypoint=True,
                                  prefix='files')
         return args
 
-    def _compute_addons(self, data, section):
+    def _compute_addons(self, data, section, job):
         if 'apt' not in data:
             return
         sources = []
-        for alias in (data['apt'].get('sources') or []):
-            for ubuntu_source in self.ubuntu_json:
-                if alias == ubuntu_source['alias']:
-                    if ubuntu_source['key_url']:
-                        sources.append(
-                            'curl -sSL "' + ubuntu_source['key_url'] +
-                            '" | apt-key add -')
-                    if ubuntu_source['sourceline'].startswith('ppa:'):
-                        sources.append(
-                            'apt-add-repository -y "' +
-                            ubuntu_source['sourceline'] + '"')
-                    else:
-                        sources.append(
-                            'echo "' + ubuntu_source['sourceline'] +
-                            '" | tee -a /etc/apt/sources.list > /dev/null')
+        aliases = data['apt'].get('sources') or []
+        ubuntu_sources = aliases and \
+            get_apt_sources(cache_path=self.cache_path)
+        for alias in aliases:
+            for ubuntu_source in ubuntu_sources.get(alias, []):
+                if ubuntu_source['key_url']:
+                    sources.append(
+                        'curl -sSL "' + ubuntu_source['key_url'] +
+                        '" | apt-key add -')
+                if ubuntu_source['sourceline'].startswith('ppa:'):
+                    sources.append(
+                        'apt-add-repository -y "' +
+                        ubuntu_source['sourceline'] + '"')
+                else:
+                    sources.append(
+                        'echo "' + ubuntu_source['sourceline'] +
+                        '" | tee -a /etc/apt/sources.list > /dev/null')
         new_data = data['apt'].copy()
         new_data['sources'] = sources
         return new_data
 
-    def _make_script(self, data, section, add_entrypoint=False, add_run=False,
-                     prefix=""):
-        file_path = os.path.join(self.curr_work_path, prefix, section)
-        self.mkdir_p(os.path.dirname(file_path))
-        with open(file_path, "w") as f_section:
-            f_section.write('#!/bin/bash\n')
-            for var, value in self.curr_exports:
-                f_section.write('\nexport %s=%s' % (var, value))
-            for line in data:
-                self.curr_exports.extend([
-                    (var, value)
-                    for _, _, var, value in self.re_export.findall(line)])
-                f_section.write('\n' + line)
-        src = "./" + os.path.relpath(file_path, self.curr_work_path)
+    def _compute_cache(self, data, *_):
+        """Get the directories of the `cache:` section, mounted as volumes
+        of `20-run.sh`, and the ones of downloads mounted as caches of
+        BuildKit
+
+        The directories under the build directory are not mounted because
+        the content of a mount is not kept in the image.
+        """
+        if not isinstance(data, dict):
+            # e.g. `cache: [pip, apt]`
+            items = {}
+            for item in data:
+                items.update(item if isinstance(item, dict) else {item: True})
+            data = items
+        directories = [CACHE_DIRECTORIES[name]
+                       for name in sorted(CACHE_DIRECTORIES)
+                       if data.get(name)]
+        directories.extend(data.get('directories') or [])
+        if self.os_kwargs['user'] == 'root':
+            home = '/root'
+        else:
+            home = '/home/' + self.os_kwargs['user']
+
+        def expand_home(directory):
+            return re.sub(r'^(\$HOME|\${HOME}|~)(?=/|$)', home,
+                          directory.strip()).rstrip('/')
+        downloads = [expand_home(directory)
+                     for directory in DOWNLOAD_CACHE_DIRECTORIES]
+        cache_directories = []
+        for directory in map(expand_home, directories):
+            if not directory.startswith(home + '/') or '$' in directory or \
+                    directory.startswith(home + '/build/'):
+                continue
+            if directory not in cache_directories:
+                cache_directories.append(directory)
+        return {
+            'cache_directories': cache_directories,
+            'cache_mounts': [directory for directory in cache_directories
+                             if directory in downloads],
+            'apt_cache_mounts': list(APT_CACHE_DIRECTORIES)
+            if data.get('apt') else [],
+        }
+
+    def _make_script(self, data, section, job, add_entrypoint=False,
+                     add_run=False, prefix=""):
+        relpath = os.path.join(prefix, section)
+        # The same section with the same exports renders the same script
+        # for every job of the matrix, so it is rendered and written once
+        key = (section, repr(data), tuple(job.exports))
+        with self._scripts_lock:
+            script = self._scripts.get(key)
+            if script is None:
+                script = self._render_script(data, job.exports)
+                self._scripts[key] = script
+        job.add_file(relpath, script['content'], executable=True,
+                     shared=True)
+        job.exports = list(script['exports'])
+        src = "./" + relpath
         dest = "/" + section
+        # The scripts of the entrypoint are added after the install, so
+        # changing them does not build the install again
         args = {
-            'copies': [(src, dest)],
+            'copies': [] if add_entrypoint else [(src, dest)],
+            'entrypoint_copies': [(src, dest)] if add_entrypoint else [],
             'entrypoints': [dest] if add_entrypoint else [],
             'runs': [dest] if add_run else [],
         }
-        self.chmod_execution(file_path)
         return args
 
-    def reset(self):
-        self.curr_work_path = None
-        self.curr_exports = []
-
-    def compute_build_scripts(self, prefix_build):
-        build_path = os.path.join(self.curr_work_path, "10-build.sh")
-        run_path = os.path.join(self.curr_work_path, "20-run.sh")
-        new_image = self.new_image + '_' + str(prefix_build)
-        with open(build_path, "w") as f_build, \
-                open(run_path, "w") as f_run:
-            build_content = self.build_template.render(
-                image=new_image,
-                dirname_dockerfile=self.curr_work_path,
-                **self.build_extra_params
-            ).strip('\n ')
-            try:
-                f_build.write(build_content.encode('utf-8'))
-            except TypeError:
-                f_build.write(build_content)
-
-            run_content = self.run_template.render(
-                image=new_image,
-                **self.run_extra_params
-            ).strip('\n ')
-            try:
-                f_run.write(run_content.encode('utf-8'))
-            except TypeError:
-                f_run.write(run_content)
-        self.chmod_execution(build_path)
-        self.chmod_execution(run_path)
+    def _render_script(self, data, exports):
+        exports = list(exports)
+        content = '#!/bin/bash\n'
+        for var, value in exports:
+            content += '\nexport %s=%s' % (var, value)
+        for line in data:
+            exports.extend([
+                (var, value)
+                for _, _, var, value in self.re_export.findall(line)])
+            content += '\n' + line
+        return {'content': self._encode(content), 'exports': exports}
+
+    def _share_script(self, job, relpath):
+        """Write a section script the first time and hardlink it for next
+        jobs with the same content
+
+        :param job Job: Job of the script
+        :param relpath str: Path of the script relative to the job work path
+        """
+        file_path = os.path.join(job.work_path, relpath)
+        digest = job.files[relpath]
+        with self._scripts_lock:
+            shared_path = self._shared_paths.get(digest)
+            if self._is_unchanged(job, relpath):
+                self._shared_paths.setdefault(digest, file_path)
+                self._count('skipped')
+                return
+            self.mkdir_p(os.path.dirname(file_path))
+            if os.path.lexists(file_path):
+                if shared_path and os.path.exists(shared_path) and \
+                        os.path.samefile(shared_path, file_path):
+                    # Already the hardlink of the script written
+                    self._count('skipped')
+                    return
+                # Unlink it instead of overwriting, it could be a hardlink
+                # shared with other job of a previous run
+                os.remove(file_path)
+            self._count('written')
+            if shared_path:
+                try:
+                    os.link(shared_path, file_path)
+                    return
+                except OSError:
+                    # e.g. the filesystem does not support hardlinks
+                    pass
+            with open(file_path, "wb") as f_section:
+                f_section.write(job.contents[relpath])
+            self.chmod_execution(file_path)
+            self._shared_paths[digest] = file_path
+
+    @staticmethod
+    def _encode(content):
+        if not isinstance(content, bytes):
+            content = content.encode('utf-8')
+        return content
+
+    def _count(self, stat_name, value=1):
+        with self._stats_lock:
+            self.stats[stat_name] = self.stats.get(stat_name, 0) + value
+
+    @staticmethod
+    def _is_unchanged(job, relpath):
+        """Check if the file was generated with the same content hash by
+        the previous run and it was not removed"""
+        return job.manifest.get(relpath) == job.files[relpath] and \
+            os.path.lexists(os.path.join(job.work_path, relpath))
+
+    def _write_file(self, job, relpath, content, executable=False):
+        """Write a generated file of the job only if its content changed
+
+        :param job Job: Job of the file
+        :param relpath str: Path of the file relative to the job work path
+        :param content str: Content of the file
+        :param executable bool: Add execution permission to the file
+        :return: Full path of the file
+        """
+        file_path = os.path.join(job.work_path, relpath)
+        content = self._encode(content)
+        if self._is_unchanged(job, relpath):
+            self._count('skipped')
+            return file_path
+        with timing.span('write file', 'io'):
+            self.mkdir_p(os.path.dirname(file_path))
+            tmp_path = file_path + '.tmp'
+            with open(tmp_path, "wb") as f_tmp:
+                f_tmp.write(content)
+            if executable:
+                self.chmod_execution(tmp_path)
+            replace(tmp_path, file_path)
+        self._count('written')
+        return file_path
+
+    @staticmethod
+    def _remove(path):
+        if os.path.isdir(path) and not os.path.islink(path):
+            shutil.rmtree(path)
+        elif os.path.lexists(path):
+            os.remove(path)
+
+    @staticmethod
+    def _load_manifest(job):
+        job.manifest = read_manifest(job.work_path) or {}
+
+    def _save_manifest(self, job):
+        """Remove the files of the previous run that were not generated
+        again and save the manifest of the current run"""
+        for relpath in set(job.manifest) - set(job.files):
+            file_path = os.path.join(job.work_path, relpath)
+            if os.path.lexists(file_path):
+                self._remove(file_path)
+                self._count('deleted')
+        if job.files == job.manifest:
+            return
+        tmp_path = job.manifest_path + '.tmp'
+        with open(tmp_path, "w") as f_manifest:
+            json.dump(job.files, f_manifest, indent=1, sort_keys=True)
+        replace(tmp_path, job.manifest_path)
+
+    def _remove_stale_jobs(self, jobs):
+        """Remove the jobs of a previous run with a bigger matrix
+
+        Just the directories with a manifest are jobs generated and just
+        the paths listed by their manifest are removed.
+        """
+        stale_jobs = get_stale_jobs(self.work_path, len(jobs))
+        for job_path, manifest in sorted(stale_jobs.items()):
+            for relpath in manifest:
+                relpath = os.path.normpath(relpath)
+                if os.path.isabs(relpath) or \
+                        relpath.split(os.sep)[0] == os.pardir:
+                    continue
+                file_path = os.path.join(job_path, relpath)
+                if os.path.lexists(file_path):
+                    self._remove(file_path)
+                    self._count('deleted')
+            os.remove(os.path.join(job_path, MANIFEST_NAME))
+            for path, _, _ in os.walk(job_path, topdown=False):
+                try:
+                    os.rmdir(path)
+                except OSError:
+                    # Not empty, e.g. a file not generated by the job
+                    pass
+
+    def compute_build_scripts(self, job):
+        if job.image is None:
+            job.image = self.new_image + '_' + str(job.count)
+        context_tar = self.tar_context and os.path.join(
+            job.work_path, CONTEXT_NAMES[self.tar_compression])
+        build_content = self.render(
+            '10-build.sh',
+            image=job.image,
+            dirname_dockerfile=job.work_path,
+            context_tar=context_tar,
+            buildkit=self.buildkit,
+            **self.build_extra_params
+        ).strip('\n ')
+        job.add_file("10-build.sh", build_content, executable=True)
+        run_content = self.render(
+            '20-run.sh',
+            image=job.image,
+            volumes=self.get_run_volumes(job),
+            **self.run_extra_params
+        ).strip('\n ')
+        job.add_file("20-run.sh", run_content, executable=True)
+
+    def get_run_volumes(self, job):
+        """Get the named volumes of the caches of a job
+
+        :return: List of tuples (volume name, volume path)
+        """
+        if not self.run_cache:
+            return []
+        prefix = 't2d-cache-%(repo_owner)s-%(repo_project)s' % self.os_kwargs
+        if self.run_cache == 'job':
+            prefix += '-%d' % job.count
+        return [(re.sub(r'[^\w.-]+', '_', prefix + directory).lower(), path)
+                for path, directory in job.run_caches]
 
     def _transform_yml_matrix2env(self):
         matrix = self.yml.pop('matrix', {})
@@ -221,86 +700,268 @@ class Travis2Docker(object):
         if envs:
             self.yml['env'] = envs
 
-    def compute_dockerfile(self, skip_after_success=False):
-        work_paths = []
+    def _get_jobs(self):
         self._transform_yml_matrix2env()
-        for count, env in enumerate(self._compute('env') or [], 1):
-            self.reset()
-            self.curr_work_path = os.path.join(self.work_path, str(count))
-            curr_dockerfile = \
-                os.path.join(self.curr_work_path, self.dockerfile)
-            entryp_path = os.path.join(self.curr_work_path, "files",
-                                       "entrypoint.sh")
-            self.mkdir_p(os.path.dirname(entryp_path))
-            entryp_relpath = os.path.relpath(entryp_path, self.curr_work_path)
-            rvm_env_path = os.path.join(self.curr_work_path, "files",
-                                        "rvm_env.sh")
-            rvm_env_relpath = os.path.relpath(rvm_env_path, self.curr_work_path)
-            copies = []
-            for copy_path, dest in self.copy_paths:
-                copies.append((self.copy_path(copy_path), dest))
-            kwargs = {'runs': [], 'copies': copies, 'entrypoints': [],
-                      'entrypoint_path': entryp_relpath, 'image': self.image,
-                      'env': env, 'packages': [], 'sources': [],
-                      'rvm_env_path': rvm_env_relpath,
-                      }
-            with open(curr_dockerfile, "w") as f_dockerfile, \
-                    open(entryp_path, "w") as f_entrypoint, \
-                    open(rvm_env_path, "w") as f_rvm:
-                for section, _ in self._sections.items():
-                    if section == 'env':
-                        continue
-                    if skip_after_success and section == 'after_success':
-                        continue
-                    result = self._compute(section)
-                    if not result:
-                        continue
-                    keys_to_extend = ['copies', 'runs', 'entrypoints',
-                                      'packages', 'sources'] \
-                        if isinstance(result, dict) else []
-                    for key_to_extend in keys_to_extend:
-                        if key_to_extend in result:
-                            kwargs[key_to_extend].extend(result[key_to_extend])
-                kwargs.update(self.os_kwargs)
-                dockerfile_content = \
-                    self.dockerfile_template.render(kwargs).strip('\n ')
-                try:
-                    f_dockerfile.write(dockerfile_content.encode('utf-8'))
-                except TypeError:
-                    f_dockerfile.write(dockerfile_content)
-                entrypoint_content = \
-                    self.entrypoint_template.render(kwargs).strip('\n ')
-                try:
-                    f_entrypoint.write(entrypoint_content.encode('utf-8'))
-                except TypeError:
-                    f_entrypoint.write(entrypoint_content)
-                rvm_env_content = self.jinja_env.get_template(
-                    'rvm_env.sh').render(kwargs).strip('\n ')
-                try:
-                    f_rvm.write(rvm_env_content.encode('UTF-8'))
-                except TypeError:
-                    f_rvm.write(rvm_env_content)
-            self.compute_build_scripts(count)
-            self.chmod_execution(entryp_path)
-            work_paths.append(self.curr_work_path)
-        self.reset()
+        return [Job(count, (env_globals + " " + env_matrix).strip(),
+                    os.path.join(self.work_path, str(count)), env_matrix)
+                for count, (env_globals, env_matrix) in enumerate(
+                    self._compute('env') or [], 1)]
+
+    def _map_jobs(self, func, jobs):
+        """Apply `func` to the jobs with the workers, keeping the order of
+        the matrix. It is lazy: each result is yielded when it is ready."""
+        if self.workers <= 1 or len(jobs) <= 1:
+            for job in jobs:
+                yield func(job)
+            return
+        pool = ThreadPool(min(self.workers, len(jobs)))
+        try:
+            for result in pool.imap(func, jobs):
+                yield result
+        finally:
+            pool.terminate()
+            pool.join()
+
+    def iter_jobs(self, skip_after_success=False):
+        """Compute the jobs of the matrix without writing anything
+
+        The jobs are yielded in the order of the matrix as soon as they are
+        computed, so the first one could be used before the last one is
+        computed.
+
+        :param skip_after_success bool: Exclude `after_success` section
+        :return: Generator of `Job` with its artifacts in memory
+        """
+        return self._iter_jobs(self._get_jobs(), skip_after_success)
+
+    def _iter_jobs(self, jobs, skip_after_success=False):
+        compute_job = functools.partial(
+            self._compute_job, skip_after_success=skip_after_success)
+        images = {}
+        for job in self._map_jobs(compute_job, jobs):
+            # The jobs with the same build context build the image of the
+            # first one of the matrix
+            job.image = images.setdefault(
+                job.context_digest(), self.new_image + '_' + str(job.count))
+            self.compute_build_scripts(job)
+            yield job
+
+    def compute_dockerfile(self, skip_after_success=False):
+        """Compute the jobs of the matrix and write them in `work_path`
+
+        :param skip_after_success bool: Exclude `after_success` section
+        :return: List of the work paths of the jobs
+        """
+        self.stats = {'written': 0, 'skipped': 0, 'deleted': 0}
+        self._shared_paths = {}
+        jobs = self._get_jobs()
+        work_paths = list(self._map_jobs(
+            self.write_job, list(self._iter_jobs(jobs, skip_after_success))))
+        self._remove_stale_jobs(jobs)
+        bake_path = os.path.join(self.work_path, BAKE_NAME)
+        if self.bake:
+            self.write_bake(jobs)
+        elif os.path.isfile(bake_path):
+            # Written by a previous run with bake
+            os.remove(bake_path)
+            self._count('deleted')
         return work_paths
 
-    def copy_path(self, path):
+    def compute_bake(self, jobs):
+        """Render a bake file of `docker buildx bake` with a target for
+        each image and a default group building all of them in parallel
+
+        :param jobs list: Jobs computed by `iter_jobs`
+        :return: Content of the docker-bake.hcl
         """
-        :param paths list: List of paths to copy
+        images = set()
+        targets = []
+        for job in jobs:
+            if job.image not in images:
+                images.add(job.image)
+                targets.append(job)
+        return self.render(
+            'docker-bake.hcl', jobs=targets, dockerfile=self.dockerfile,
+            **self.bake_params).strip('\n ') + '\n'
+
+    def write_bake(self, jobs):
+        """Write the docker-bake.hcl of the jobs in `work_path` if it
+        changed
+
+        :return: Path of the bake file
         """
-        src = os.path.expandvars(os.path.expanduser(path))
-        basename = os.path.basename(src)
-        dest_path = os.path.expandvars(os.path.expanduser(
-            os.path.join(self.curr_work_path, basename)))
-        if os.path.isdir(dest_path):
-            shutil.rmtree(dest_path)
-        if os.path.isdir(src):
-            shutil.copytree(src, dest_path)
-        elif os.path.isfile(src):
-            shutil.copy(src, dest_path)
+        bake_path = os.path.join(self.work_path, BAKE_NAME)
+        content = self._encode(self.compute_bake(jobs))
+        if os.path.isfile(bake_path):
+            with open(bake_path, 'rb') as f_bake:
+                if f_bake.read() == content:
+                    self._count('skipped')
+                    return bake_path
+        self.mkdir_p(self.work_path)
+        with open(bake_path + '.tmp', 'wb') as f_bake:
+            f_bake.write(content)
+        replace(bake_path + '.tmp', bake_path)
+        self._count('written')
+        return bake_path
+
+    def write_job(self, job):
+        """Write the artifacts of a job computed in its work path.
+        Just the files changed since the previous run are written.
+
+        :param job Job: Job yielded by `iter_jobs`
+        :return: Work path of the job
+        """
+        self._load_manifest(job)
+        job.files = {}
+        if self.tar_context:
+            self._write_context(job)
         else:
+            for src, _ in job.copies:
+                self.copy_path(src, job)
+        for relpath, content in job.contents.items():
+            if self.tar_context and relpath not in BUILD_SCRIPTS:
+                continue
+            job.files[relpath] = hashlib.sha1(content).hexdigest()
+            if relpath in job.shared:
+                self._share_script(job, relpath)
+            else:
+                self._write_file(job, relpath, content,
+                                 executable=relpath in job.executables)
+        self._save_manifest(job)
+        return job.work_path
+
+    def _write_context(self, job):
+        """Write the archive of the build context of the job, keeping the
+        previous one if it did not change"""
+        relpath = CONTEXT_NAMES[self.tar_compression]
+        file_path = os.path.join(job.work_path, relpath)
+        self.mkdir_p(job.work_path)
+        tmp_path = file_path + '.tmp'
+        with timing.span('write context', 'io'):
+            with open(tmp_path, 'wb') as f_context:
+                job.files[relpath] = write_context(
+                    job, f_context, self.tar_compression,
+                    exclude=BUILD_SCRIPTS)
+        if self._is_unchanged(job, relpath):
+            os.remove(tmp_path)
+            self._count('skipped')
+            return
+        replace(tmp_path, file_path)
+        self._count('written')
+
+    def _compute_job(self, job, skip_after_success=False):
+        entryp_relpath = os.path.join("files", "entrypoint.sh")
+        rvm_env_relpath = os.path.join("files", "rvm_env.sh")
+        copies = []
+        for copy_path, dest in self.copy_paths or []:
+            src = self._copy_src(copy_path)
+            relpath = os.path.basename(src)
+            job.copies.append((src, relpath))
+            copies.append((relpath, dest))
+        git_bundle_src = None
+        if self.git_bundle:
+            # Added just before the fetch because it changes on each commit
+            src = self._copy_src(self.git_bundle)
+            git_bundle_src = os.path.basename(src)
+            job.copies.append((src, git_bundle_src))
+        kwargs = {'runs': [], 'copies': copies, 'entrypoints': [],
+                  'entrypoint_copies': [],
+                  'entrypoint_path': entryp_relpath, 'image': self.image,
+                  'env': job.env, 'packages': [], 'sources': [],
+                  'rvm_env_path': rvm_env_relpath, 'buildkit': self.buildkit,
+                  'cache_directories': [], 'cache_mounts': [],
+                  'apt_cache_mounts': [],
+                  'git_bundle': self.git_bundle and GIT_BUNDLE_PATH,
+                  'git_bundle_src': git_bundle_src,
+                  }
+        for section, _ in self._sections.items():
+            if section == 'env':
+                continue
+            if skip_after_success and section == 'after_success':
+                continue
+            result = self._compute(section, job)
+            if not result:
+                continue
+            keys_to_extend = ['copies', 'entrypoint_copies', 'runs',
+                              'entrypoints', 'packages', 'sources',
+                              'cache_directories', 'cache_mounts',
+                              'apt_cache_mounts'] \
+                if isinstance(result, dict) else []
+            for key_to_extend in keys_to_extend:
+                if key_to_extend in result:
+                    kwargs[key_to_extend].extend(result[key_to_extend])
+        if self.run_cache:
+            job.run_caches = [
+                ('%s/%d' % (RUN_CACHES_PATH, index), directory)
+                for index, directory in enumerate(
+                    kwargs['cache_directories'])]
+        kwargs['run_caches'] = job.run_caches
+        kwargs['run_caches_path'] = RUN_CACHES_PATH
+        if self.shared_install and kwargs['runs'] and \
+                not self._uses_env_matrix(job, kwargs['runs']):
+            env_global = job.env[:len(job.env) - len(job.env_matrix)]
+            kwargs['env'] = env_global.strip()
+            kwargs['env_after_runs'] = job.env_matrix
+        kwargs.update(self.os_kwargs)
+        dockerfile_content = \
+            self.render('Dockerfile', kwargs).strip('\n ')
+        job.add_file(self.dockerfile, dockerfile_content)
+        entrypoint_content = \
+            self.render('entrypoint.sh', kwargs).strip('\n ')
+        job.add_file(entryp_relpath, entrypoint_content, executable=True)
+        rvm_env_content = self.render('rvm_env.sh', kwargs).strip('\n ')
+        job.add_file(rvm_env_relpath, rvm_env_content)
+        return job
+
+    def _uses_env_matrix(self, job, runs):
+        """Check if the scripts of the runs reference a variable of the
+        row of the matrix"""
+        names = [var for var, _ in self.re_env.findall(job.env_matrix) if var]
+        if not names:
+            return False
+        re_names = re.compile(r'\$\{?(%s)\b' % '|'.join(names))
+        return any(re_names.search(job.contents[os.path.join(
+            'files', run.lstrip('/'))].decode('utf-8')) for run in runs)
+
+    @staticmethod
+    def _copy_src(path):
+        src = os.path.expandvars(os.path.expanduser(path))
+        if not os.path.isdir(src) and not os.path.isfile(src):
             raise UserWarning(
                 "Just directory or file is supported to copy [%s]" % src)
-        return os.path.relpath(dest_path, self.curr_work_path)
+        return src
+
+    def copy_path(self, path, job):
+        """Copy a file or directory into the job if it changed
+
+        With a `cache_path` the path is staged once in its store and the
+        job gets hardlinks to the staged files.
+
+        :param path str: Path of file or directory to copy
+        :param job Job: Job where it is copied
+        :return: Path of the copy relative to the job work path
+        """
+        src = self._copy_src(path)
+        relpath = os.path.basename(src)
+        dest_path = os.path.join(job.work_path, relpath)
+        with timing.span('copy path', 'io'):
+            return self._copy_path(src, relpath, dest_path, job)
+
+    def _copy_path(self, src, relpath, dest_path, job):
+        if self.store:
+            staged_path, job.files[relpath] = self.store.stage(src)
+        else:
+            job.files[relpath] = digest_path(src)
+        if self._is_unchanged(job, relpath):
+            self._count('skipped')
+            return relpath
+        self.mkdir_p(job.work_path)
+        self._remove(dest_path)
+        if self.store:
+            link_path(staged_path, dest_path)
+        elif os.path.isdir(src):
+            shutil.copytree(src, dest_path)
+        else:
+            shutil.copy(src, dest_path)
+        self._count('written')
+        return relpath
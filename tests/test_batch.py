@@ -0,0 +1,62 @@
+import json
+import os
+
+from test_git_run import git
+from test_git_run import make_repo
+
+from travis2docker import batch
+from travis2docker.git_run import GitRun
+
+
+def test_batch(tmpdir, monkeypatch):
+    monkeypatch.setenv('HOME', str(tmpdir))
+    tmpdir.mkdir('.ssh')
+    repo_path = make_repo(tmpdir)
+    with open(os.path.join(repo_path, '.travis.yml'), 'w') as f_yml:
+        f_yml.write('env:\n  - A=1\n  - A=2\nscript:\n  - echo ok\n')
+    git(repo_path, 'checkout', '-q', '-b', 'feature')
+    git(repo_path, 'commit', '-q', '-a', '-m', 'matrix')
+    manifest = tmpdir.join('manifest.json')
+    manifest.write(json.dumps([
+        {'repo': repo_path, 'revision': 'master'},
+        {'repo': repo_path, 'revision': 'feature',
+         'options': '--docker-user=odoo'},
+        {'repo': repo_path, 'revision': 'missing'},
+        {'repo': repo_path},
+        {'repo': repo_path, 'revision': 'master',
+         'options': '--git-bundle --depth=1'},
+        {'repo': repo_path, 'revision': 'master',
+         'options': '--docker-user=odoo'},
+        {'repo': repo_path, 'revision': 'other', 'options': '--depth=1'},
+    ]))
+    updates = []
+
+    def update(self, revision=None):
+        updates.append(revision)
+        return original_update(self, revision)
+    original_update = GitRun.update
+    monkeypatch.setattr(GitRun, 'update', update)
+    summary_path = str(tmpdir.join('summary.json'))
+    root_path = str(tmpdir.join('root'))
+    assert batch.main([str(manifest), '--root-path=' + root_path,
+                       '--summary', summary_path]) == 1
+    assert updates == [['feature', 'master', 'missing']]
+    with open(summary_path) as f_summary:
+        summary = json.load(f_summary)
+    assert summary['failures'] == 5
+    (master, feature, missing, invalid, bundle, duplicated,
+     depth) = summary['entries']
+    assert len(master['work_paths']) == 1
+    assert len(feature['work_paths']) == 2
+    assert master['error'] is None and feature['error'] is None
+    assert missing['error'].startswith('InvalidRepoBranchError')
+    assert invalid['error'].startswith('KeyError')
+    assert bundle['error'].startswith('ValueError')
+    assert '--git-bundle requires' in bundle['error']
+    assert duplicated['error'].startswith('ValueError')
+    assert 'as the entry 0' in duplicated['error']
+    assert not duplicated['work_paths']
+    assert depth['error'].startswith('ValueError')
+    assert '--depth' in depth['error']
+    with open(os.path.join(feature['work_paths'][0], 'Dockerfile')) as f_dkr:
+        assert 'USER odoo' in f_dkr.read()
@@ -0,0 +1,218 @@
+import json
+import os
+import subprocess
+import threading
+import time
+
+from travis2docker import timing
+from travis2docker.cli import get_git_data
+from travis2docker.git_run import GitRun
+
+
+def git(path, *args):
+    return subprocess.check_output(
+        ['git', '-C', path, '-c', 'user.name=travis2docker',
+         '-c', 'user.email=travis2docker@example.com'] + list(args),
+    ).decode('utf-8').strip()
+
+
+def make_repo(tmpdir, commits=1):
+    repo_path = str(tmpdir.mkdir('origin'))
+    git(repo_path, 'init', '-q')
+    git(repo_path, 'checkout', '-q', '-b', 'master')
+    for count in range(commits):
+        with open(os.path.join(repo_path, '.travis.yml'), 'w') as f_yml:
+            f_yml.write('script:\n  - echo %d\n' % count)
+        git(repo_path, 'add', '.travis.yml')
+        git(repo_path, 'commit', '-q', '-m', 'commit %d' % count)
+    return repo_path
+
+
+def test_cat_file(tmpdir):
+    repo_path = make_repo(tmpdir, commits=3)
+    with GitRun(repo_path, str(tmpdir.join('cache')),
+                path_prefix_repo=True) as git_obj:
+        git_obj.update()
+        for count in range(3):
+            revision = 'master~%d' % count
+            assert git_obj.get_sha(revision) == \
+                git(repo_path, 'rev-parse', revision)
+            assert git_obj.show_file('.travis.yml', revision) == \
+                'script:\n  - echo %d\n' % (2 - count)
+        assert git_obj.show_file('missing.yml', 'master') is None
+        assert git_obj.get_sha('missing-branch') is None
+        assert git_obj.object_exists('master')
+        assert not git_obj.object_exists('missing-branch')
+        # Just a process for each option was used
+        assert len(git_obj._batches) == 2
+        processes = list(git_obj._batches.values())
+    assert not git_obj._batches
+    assert all(process.returncode == 0 for process in processes)
+
+
+def test_cat_file_fallback(tmpdir):
+    repo_path = make_repo(tmpdir)
+    git_obj = GitRun(repo_path, str(tmpdir.join('cache')),
+                     path_prefix_repo=True)
+    git_obj.update()
+
+    def broken_process(option):
+        raise OSError("git cat-file %s is not working" % option)
+    git_obj._batch_process = broken_process
+    assert git_obj.get_sha('master') == git(repo_path, 'rev-parse', 'master')
+    assert git_obj.show_file('.travis.yml', 'master') == \
+        'script:\n  - echo 0\n'
+    assert git_obj.object_exists('master')
+
+
+def test_update_revision(tmpdir):
+    repo_path = make_repo(tmpdir)
+    git(repo_path, 'branch', 'feature')
+    git(repo_path, 'update-ref', 'refs/pull/1/head', 'master')
+    git_obj = GitRun(repo_path, str(tmpdir.join('cache')),
+                     path_prefix_repo=True)
+    git_obj.update('pull/1')
+    assert sorted(git_obj.get_ref_data(['refs/heads', 'refs/pull'])) == [
+        'refs/heads/feature', 'refs/heads/master', 'refs/pull/1']
+
+    git(repo_path, 'commit', '-q', '--allow-empty', '-m', 'new commit')
+    git(repo_path, 'update-ref', 'refs/pull/2/head', 'master')
+    git(repo_path, 'branch', '-f', 'feature', 'master')
+    git_obj.update('feature')
+    assert git_obj.get_sha('feature') == git(repo_path, 'rev-parse', 'master')
+    # Just the branch requested was fetched
+    assert git_obj.get_sha('master') == git(repo_path, 'rev-parse', 'master~1')
+    assert not git_obj.object_exists('pull/2')
+
+    git_obj.update()
+    assert git_obj.get_sha('master') == git(repo_path, 'rev-parse', 'master')
+    assert git_obj.get_sha('pull/2') == git(repo_path, 'rev-parse', 'master')
+
+
+def test_update_partial(tmpdir):
+    repo_path = make_repo(tmpdir, commits=3)
+    with open(os.path.join(repo_path, 'big_file'), 'wb') as f_big:
+        f_big.write(os.urandom(1024 * 1024))
+    git(repo_path, 'add', 'big_file')
+    git(repo_path, 'commit', '-q', '-m', 'big file')
+    git(repo_path, 'config', 'uploadpack.allowFilter', 'true')
+    big_sha = git(repo_path, 'rev-parse', 'master:big_file')
+    with GitRun(repo_path, str(tmpdir.join('cache')), path_prefix_repo=True,
+                partial=True, depth=1) as git_obj:
+        git_obj.update('master')
+        assert git_obj.show_file('.travis.yml', 'master') == \
+            'script:\n  - echo 2\n'
+        local_objects = git(git_obj.path, 'cat-file', '--batch-check',
+                            '--batch-all-objects')
+        assert big_sha not in local_objects
+        assert git(git_obj.path, 'rev-list', '--count', 'master') == '1'
+
+
+def test_is_updated(tmpdir, monkeypatch):
+    repo_path = make_repo(tmpdir)
+    sha = git(repo_path, 'rev-parse', 'master')
+    cache_path = str(tmpdir.join('cache'))
+    git_obj = GitRun(repo_path, cache_path, path_prefix_repo=True)
+    assert not git_obj.is_updated(sha)
+    data = get_git_data(repo_path, cache_path, sha)
+    assert data['sha'] == sha
+    assert data['content'] == 'script:\n  - echo 0\n'
+    assert git_obj.is_updated(sha)
+    assert not git_obj.is_updated('f' * 40)
+
+    git_obj.update('master')
+    assert git_obj.is_updated('master', ttl=60)
+    assert not git_obj.is_updated('master')
+    assert not git_obj.is_updated('pull/1', ttl=60)
+    # The fetch of a missing revision fails and it is not updated
+    git_obj.update('missing')
+    git_obj.update(['feature', 'master'])
+    assert 'missing' not in git_obj.get_fetch_times()
+    assert 'feature' not in git_obj.get_fetch_times()
+    assert git_obj.is_updated('master', ttl=60)
+    git_obj.update()
+    assert git_obj.is_updated('master', ttl=60)
+
+    def update(self, revision=None):
+        raise AssertionError("The revision should not be fetched")
+    monkeypatch.setattr(GitRun, 'update', update)
+    assert get_git_data(repo_path, cache_path, sha)['sha'] == sha
+    assert get_git_data(repo_path, cache_path, 'master',
+                        fetch_ttl=60)['sha'] == sha
+
+
+def test_update_lock(tmpdir, monkeypatch):
+    repo_path = make_repo(tmpdir)
+    cache_path = str(tmpdir.join('cache'))
+    GitRun(repo_path, cache_path, path_prefix_repo=True).update('master')
+    fetches = []
+
+    def run(self, cmd):
+        if cmd[0] == 'fetch':
+            fetches.append(cmd)
+            time.sleep(0.5)
+        return original_run(self, cmd)
+    original_run = GitRun.run
+    monkeypatch.setattr(GitRun, 'run', run)
+    threads = [
+        threading.Thread(target=GitRun(
+            repo_path, cache_path, path_prefix_repo=True).update,
+            args=('master',))
+        for _ in range(3)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    # The first fetch is reused by the processes waiting for it
+    assert len(fetches) == 1
+    assert os.path.isfile(
+        os.path.join(cache_path, GitRun.url2dirname(repo_path) + '.lock'))
+
+
+def test_git_timings(tmpdir, capfd):
+    repo_path = make_repo(tmpdir)
+    recorder = timing.enable()
+    try:
+        get_git_data(repo_path, str(tmpdir.join('cache')), 'master')
+        get_git_data(repo_path, str(tmpdir.join('cache')), 'missing')
+    finally:
+        timing.disable()
+    assert capfd.readouterr().out == ''
+    events = [(event['name'], event['args'].get('returncode'))
+              for event in recorder.events if event['cat'] == 'git']
+    assert ('git clone', 0) in events
+    assert ('git fetch', 0) in events
+    assert ('git fetch', 128) in events
+    assert events.count(('get_git_data', None)) == 2
+    trace_path = str(tmpdir.join('trace.json'))
+    recorder.write_trace(trace_path)
+    with open(trace_path) as f_trace:
+        trace = json.load(f_trace)
+    assert len(trace['traceEvents']) == len(recorder.events)
+    assert all(event['ph'] == 'X' for event in trace['traceEvents'])
+    assert 'git fetch' in recorder.format_table()
+
+
+def test_bundle(tmpdir):
+    repo_path = make_repo(tmpdir, commits=2)
+    sha = git(repo_path, 'rev-parse', 'HEAD')
+    git(repo_path, 'update-ref', 'refs/pull/1/head', 'HEAD~1')
+    with GitRun(repo_path, str(tmpdir.join('cache')),
+                path_prefix_repo=True) as git_obj:
+        git_obj.update()
+        refs = list(git_obj.get_ref_data(['refs']))
+        for revision, expected in (('master', sha), ('pull/1', 'HEAD~1'),
+                                   (sha, sha)):
+            bundle_path = str(tmpdir.join('bundle'))
+            assert git_obj.bundle(revision, bundle_path) == \
+                git(repo_path, 'rev-parse', expected)
+            # Fetched as the Dockerfile fetches the revision from origin
+            clone_path = str(tmpdir.join('clone-' + expected))
+            git(repo_path, 'init', '-q', clone_path)
+            git(clone_path, 'fetch', '--update-head-ok', '-p', bundle_path,
+                GitRun.revision2refspec(revision))
+            git(clone_path, 'checkout', '-qf', revision)
+            assert git(clone_path, 'rev-parse', 'HEAD') == \
+                git(repo_path, 'rev-parse', expected)
+        # The refs of the cache were not changed
+        assert list(git_obj.get_ref_data(['refs'])) == refs
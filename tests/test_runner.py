@@ -0,0 +1,55 @@
+import json
+import os
+import stat
+from xml.etree import ElementTree
+
+from travis2docker import runner
+from travis2docker.travis2docker import Travis2Docker
+
+FAKE_DOCKER = """#!/bin/bash
+echo "docker $@"
+if [ "$1" == "run" ] && [[ "$@" == *"master_2"* ]]; then
+    exit 3
+fi
+"""
+
+
+def test_runner(tmpdir, monkeypatch):
+    bin_path = tmpdir.mkdir('bin')
+    docker_path = bin_path.join('docker')
+    docker_path.write(FAKE_DOCKER)
+    os.chmod(str(docker_path), os.stat(str(docker_path)).st_mode | stat.S_IEXEC)
+    monkeypatch.setenv('PATH', str(bin_path) + os.pathsep +
+                       os.environ['PATH'])
+    yml = 'env:\n  - A=1\n  - A=2\n  - A=3\nscript:\n  - echo ok\n'
+    t2d = Travis2Docker(yml, work_path=str(tmpdir.join('scripts')),
+                        os_kwargs={'repo_owner': 'owner',
+                                   'repo_project': 'project',
+                                   'revision': 'master', 'project': 'foo'})
+    t2d.run_extra_params = {'extra_params': '-e LANG=C.UTF-8'}
+    work_paths = t2d.compute_dockerfile()
+    logs_path = str(tmpdir.join('logs'))
+    summary_path = str(tmpdir.join('summary.json'))
+    junit_path = str(tmpdir.join('junit.xml'))
+    assert runner.main(work_paths + [
+        '--workers', '3', '--logs-path', logs_path, '--run-args=--rm',
+        '--summary', summary_path, '--junit', junit_path]) == 1
+    with open(summary_path) as f_summary:
+        summary = json.load(f_summary)
+    assert summary['failures'] == 1
+    assert [job['name'] for job in summary['jobs']] == ['1', '2', '3']
+    assert [job['status'] for job in summary['jobs']] == [
+        'passed', 'failed', 'passed']
+    assert summary['jobs'][1]['returncode'] == 3
+    assert all(job['build_returncode'] == 0 for job in summary['jobs'])
+    with open(os.path.join(logs_path, '2.log')) as f_log:
+        log = f_log.read()
+    assert 'docker build' in log
+    # Without a TTY
+    assert 'docker run -e LANG=C.UTF-8 --rm owner-project:master_2' in log
+
+    suite = ElementTree.parse(junit_path).getroot()
+    assert suite.get('tests') == '3' and suite.get('failures') == '1'
+    failures = [case.get('name') for case in suite.findall('testcase')
+                if case.find('failure') is not None]
+    assert failures == ['2']
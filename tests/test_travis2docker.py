@@ -1,10 +1,22 @@
 from __future__ import print_function
 
+import io
+import json
 import os
+import re
+import shutil
+import stat
 import subprocess
 import sys
+import tarfile
 
+import pytest
+
+from travis2docker import cli
+from travis2docker import templating
+from travis2docker import travis2docker
 from travis2docker.cli import main
+from travis2docker.travis2docker import Travis2Docker
 
 try:
     from shutil import which  # python3.x
@@ -40,6 +52,573 @@ def check_failed_dockerfile(scripts, lines_required=None):
             print(fdkr_lines)
 
 
+def read_tree(path):
+    tree = {}
+    for root, _, files in os.walk(path):
+        for fname in files:
+            fpath = os.path.join(root, fname)
+            with open(fpath, 'rb') as fobj:
+                tree[os.path.relpath(fpath, path)] = (
+                    fobj.read(), os.stat(fpath).st_mode)
+    return tree
+
+
+MATRIX_YML = """
+env:
+  global:
+  - VARIABLE_GLOBAL="value global"
+  matrix:
+%s
+install:
+  - export INSTALLED=1
+  - touch install
+script:
+  - touch script
+"""
+
+
+def os_kwargs():
+    return {'repo_owner': 'owner', 'repo_project': 'project',
+            'revision': 'master', 'project': 'foo'}
+
+
+def test_compute_dockerfile_workers(tmpdir):
+    yml = MATRIX_YML % '\n'.join(
+        '  - VARIABLE_MATRIX="value %d"' % count for count in range(12))
+    trees = []
+    work_path = str(tmpdir.join('scripts'))
+    for workers in (None, 4):
+        t2d = Travis2Docker(yml, work_path=work_path, workers=workers,
+                            os_kwargs=os_kwargs())
+        scripts = t2d.compute_dockerfile()
+        assert scripts == [os.path.join(work_path, str(count))
+                           for count in range(1, 13)]
+        trees.append(read_tree(work_path))
+        shutil.rmtree(work_path)
+    assert trees[0] == trees[1]
+    assert b'export INSTALLED=1' in trees[1][os.path.join('3', 'files',
+                                                          'script')][0]
+
+
+def test_compute_dockerfile_shared_scripts(tmpdir):
+    yml = MATRIX_YML % '\n'.join(
+        '  - VARIABLE_MATRIX="value %d"' % count for count in range(3))
+    work_path = str(tmpdir.join('scripts'))
+    for _ in range(2):
+        t2d = Travis2Docker(yml, work_path=work_path, os_kwargs=os_kwargs())
+        scripts = t2d.compute_dockerfile()
+        inodes = set(
+            os.stat(os.path.join(script, 'files', 'script')).st_ino
+            for script in scripts)
+        assert len(inodes) == 1
+        with open(os.path.join(scripts[-1], 'files', 'script')) as f_script:
+            assert f_script.read() == \
+                '#!/bin/bash\n\nexport INSTALLED=1\ntouch script'
+    # The scripts already hardlinked are not written again
+    for script in scripts[1:]:
+        os.remove(os.path.join(script, '.t2d-manifest.json'))
+    t2d = Travis2Docker(yml, work_path=work_path, os_kwargs=os_kwargs())
+    t2d.compute_dockerfile()
+    assert t2d.stats == {'written': 10, 'skipped': 11, 'deleted': 0}
+
+
+def test_compute_dockerfile_incremental(tmpdir):
+    work_path = str(tmpdir.join('scripts'))
+    rcfile = tmpdir.join('rcfile')
+    rcfile.write('alias ll="ls -l"')
+    yml = MATRIX_YML % '\n'.join(
+        '  - VARIABLE_MATRIX="value %d"' % count for count in range(3))
+    t2d = Travis2Docker(yml, work_path=work_path, os_kwargs=os_kwargs(),
+                        copy_paths=[(str(rcfile), '$HOME/.rcfile')])
+    scripts = t2d.compute_dockerfile()
+    assert t2d.stats == {'written': 24, 'skipped': 0, 'deleted': 0}
+    dockerfile = os.path.join(scripts[0], 'Dockerfile')
+    os.utime(dockerfile, (0, 0))
+
+    t2d = Travis2Docker(yml, work_path=work_path, os_kwargs=os_kwargs(),
+                        copy_paths=[(str(rcfile), '$HOME/.rcfile')])
+    t2d.compute_dockerfile()
+    assert t2d.stats == {'written': 0, 'skipped': 24, 'deleted': 0}
+    assert os.stat(dockerfile).st_mtime == 0
+
+    # A smaller matrix without copies removes the stale files
+    yml = MATRIX_YML % '  - VARIABLE_MATRIX="value 0"'
+    t2d = Travis2Docker(yml, work_path=work_path, os_kwargs=os_kwargs())
+    assert t2d.compute_dockerfile() == scripts[:1]
+    # Just the Dockerfile changes because of the copy removed
+    assert t2d.stats['written'] == 1
+    assert sorted(os.listdir(work_path)) == ['1']
+    assert not os.path.exists(os.path.join(scripts[0], 'rcfile'))
+
+    # Just the files of the jobs generated are removed
+    tmpdir.join('scripts', '2024').ensure('notes.txt')
+    yml = MATRIX_YML % '\n'.join(
+        '  - VARIABLE_MATRIX="value %d"' % count for count in range(2))
+    t2d = Travis2Docker(yml, work_path=work_path, os_kwargs=os_kwargs())
+    scripts = t2d.compute_dockerfile()
+    tmpdir.join('scripts', '2', 'notes.txt').write('notes')
+    yml = MATRIX_YML % '  - VARIABLE_MATRIX="value 0"'
+    t2d = Travis2Docker(yml, work_path=work_path, os_kwargs=os_kwargs())
+    t2d.compute_dockerfile()
+    assert t2d.stats['deleted'] == 7
+    assert sorted(os.listdir(work_path)) == ['1', '2', '2024']
+    assert os.listdir(scripts[1]) == ['notes.txt']
+    assert os.listdir(os.path.join(work_path, '2024')) == ['notes.txt']
+
+
+def test_iter_jobs(tmpdir):
+    work_path = str(tmpdir.join('scripts'))
+    rcfile = tmpdir.join('rcfile')
+    rcfile.write('alias ll="ls -l"')
+    yml = MATRIX_YML % '\n'.join(
+        '  - VARIABLE_MATRIX="value %d"' % count for count in range(3))
+    t2d = Travis2Docker(yml, work_path=work_path, os_kwargs=os_kwargs(),
+                        copy_paths=[(str(rcfile), '$HOME/.rcfile')])
+    jobs = t2d.iter_jobs()
+    job = next(jobs)
+    assert job.count == 1
+    assert job.image == 'owner-project:master_1'
+    assert job.copies == [(str(rcfile), 'rcfile')]
+    assert b'VARIABLE_MATRIX="value 0"' in job.contents['Dockerfile']
+    assert os.path.join('files', 'script') in job.executables
+    jobs = [job] + list(jobs)
+    assert not os.path.exists(work_path)
+
+    # The writer is a consumer of the jobs computed
+    for job in jobs:
+        t2d.write_job(job)
+    tree = read_tree(work_path)
+    for job in jobs:
+        for relpath, content in job.contents.items():
+            data, mode = tree[os.path.join(str(job.count), relpath)]
+            assert data == content
+            assert bool(mode & stat.S_IEXEC) == (relpath in job.executables)
+    shutil.rmtree(work_path)
+    t2d.compute_dockerfile()
+    assert read_tree(work_path) == tree
+
+
+def test_tar_context(tmpdir, monkeypatch):
+    work_path = str(tmpdir.join('scripts'))
+    rcdir = tmpdir.mkdir('rcdir')
+    rcdir.join('rcfile').write('alias ll="ls -l"')
+    yml = MATRIX_YML % '\n'.join(
+        '  - VARIABLE_MATRIX="value %d"' % count for count in range(2))
+    for _ in range(2):
+        t2d = Travis2Docker(yml, work_path=work_path, os_kwargs=os_kwargs(),
+                            copy_paths=[(str(rcdir), '$HOME/rcdir')],
+                            tar_context=True, tar_compression='gzip')
+        scripts = t2d.compute_dockerfile()
+    assert t2d.stats == {'written': 0, 'skipped': 6, 'deleted': 0}
+    context_path = os.path.join(scripts[0], 'context.tar.gz')
+    assert sorted(os.listdir(scripts[0])) == [
+        '.t2d-manifest.json', '10-build.sh', '20-run.sh', 'context.tar.gz']
+    with open(os.path.join(scripts[0], '10-build.sh')) as f_build:
+        assert f_build.read().endswith('-t $IMAGE - < %s' % context_path)
+    job = next(t2d.iter_jobs())
+    with tarfile.open(context_path) as tar:
+        assert tar.extractfile('rcdir/rcfile').read() == b'alias ll="ls -l"'
+        for relpath, content in job.contents.items():
+            if relpath in ('10-build.sh', '20-run.sh'):
+                continue
+            assert tar.extractfile(relpath).read() == content
+
+    # The same archive is written to stdout
+    stdout = io.BytesIO()
+    monkeypatch.setattr(sys, 'stdout', stdout)
+    cli.write_job_context(t2d, 1)
+    with open(context_path, 'rb') as f_context:
+        assert stdout.getvalue() == f_context.read()
+
+
+def test_bake(tmpdir):
+    work_path = str(tmpdir.join('scripts'))
+    yml = MATRIX_YML % '\n'.join(
+        '  - VARIABLE_MATRIX="value %d"' % count for count in range(3))
+    t2d = Travis2Docker(yml, work_path=work_path, os_kwargs=os_kwargs(),
+                        bake=True)
+    t2d.bake_params = {'cache_from': ['type=registry,ref=cache/t2d'],
+                       'cache_to': ['type=inline']}
+    scripts = t2d.compute_dockerfile()
+    with open(os.path.join(work_path, 'docker-bake.hcl')) as f_bake:
+        content = f_bake.read()
+    blocks = dict(re.findall(r'^(\w+ "[\w-]+") \{\n(.*?)^\}', content,
+                             re.M | re.S))
+    assert re.search(r'targets = \["job-1", "job-2", "job-3"\]',
+                     blocks.pop('group "default"'))
+    assert len(blocks) == len(scripts)
+    for count, script in enumerate(scripts, 1):
+        target = dict(re.findall(r'^  ([\w-]+) = (.*)$',
+                                 blocks['target "job-%d"' % count], re.M))
+        assert json.loads(target['context']) == script
+        assert os.path.isfile(os.path.join(
+            script, json.loads(target['dockerfile'])))
+        assert json.loads(target['tags']) == [
+            'owner-project:master_%d' % count]
+        assert json.loads(target['cache-from']) == [
+            'type=registry,ref=cache/t2d']
+        assert json.loads(target['cache-to']) == ['type=inline']
+    t2d.compute_dockerfile()
+    assert t2d.stats['written'] == 0
+
+
+def test_buildkit_cache(tmpdir):
+    yml = MATRIX_YML % '  - VARIABLE_MATRIX="value"' + """
+cache:
+  apt: true
+  pip: true
+  cargo: true
+  directories:
+  - $HOME/.npm
+  - $HOME/.cache/pip
+  - $HOME/.local
+  - node_modules
+addons:
+  apt:
+    packages:
+    - expect-dev
+"""
+    dockerfiles = []
+    for buildkit in (False, True):
+        work_path = str(tmpdir.join('scripts-%s' % buildkit))
+        t2d = Travis2Docker(yml, work_path=work_path, os_kwargs=os_kwargs(),
+                            buildkit=buildkit)
+        script, = t2d.compute_dockerfile()
+        with open(os.path.join(script, 'Dockerfile')) as f_dockerfile:
+            dockerfiles.append(f_dockerfile.read())
+        with open(os.path.join(script, '10-build.sh')) as f_build:
+            assert ('DOCKER_BUILDKIT=1' in f_build.read()) == buildkit
+    assert '--mount' not in dockerfiles[0]
+    assert 'RUN apt-get update; apt-get install expect-dev' in dockerfiles[0]
+    assert dockerfiles[1].startswith('# syntax=docker/dockerfile:1\n')
+    assert re.search(
+        r'^RUN --mount=type=cache,target=/var/cache/apt,sharing=locked \\\n'
+        r'.* && \{ apt-get update; apt-get install expect-dev; \}$',
+        dockerfiles[1], re.M | re.S)
+    assert re.search(
+        r'^RUN --mount=type=cache,target=/root/\.cache/pip '
+        r'--mount=type=cache,target=/root/\.npm /bin/bash ',
+        dockerfiles[1], re.M)
+    assert 'node_modules' not in dockerfiles[1]
+    # Just the caches of downloads are mounted, the content of a mount is
+    # not in the image, e.g. the apt lists or a toolchain in ~/.cargo
+    assert sorted(re.findall(r'--mount=type=cache,target=([^, ]+)',
+                             dockerfiles[1])) == [
+        '/root/.cache/pip', '/root/.npm', '/var/cache/apt']
+
+
+def test_run_cache(tmpdir):
+    yml = MATRIX_YML % '\n'.join(
+        '  - VARIABLE_MATRIX="value %d"' % count for count in range(2)) + """
+cache:
+  directories:
+  - $HOME/.cache/pip
+"""
+    volumes = {}
+    for run_cache in ('repo', 'job'):
+        work_path = str(tmpdir.join('scripts-' + run_cache))
+        t2d = Travis2Docker(yml, work_path=work_path, os_kwargs=os_kwargs(),
+                            run_cache=run_cache)
+        for script in t2d.compute_dockerfile():
+            with open(os.path.join(script, '20-run.sh')) as f_run:
+                volumes.setdefault(run_cache, set()).update(
+                    re.findall(r' -v ([\w.-]+):/t2d-cache/0 ', f_run.read()))
+            entrypoint = os.path.join(script, 'files', 'entrypoint.sh')
+            with open(entrypoint) as f_entrypoint:
+                content = f_entrypoint.read()
+            assert 'cp -au /t2d-cache/0/data/. /root/.cache/pip/' in content
+            assert 'cp -au /root/.cache/pip/. /t2d-cache/0/data/' in content
+            subprocess.check_call(['bash', '-n', entrypoint])
+    assert volumes['repo'] == {'t2d-cache-owner-project_root_.cache_pip'}
+    assert volumes['job'] == {'t2d-cache-owner-project-1_root_.cache_pip',
+                              't2d-cache-owner-project-2_root_.cache_pip'}
+
+
+def test_shared_install(tmpdir):
+    yml = MATRIX_YML % '\n'.join(
+        '  - VARIABLE_MATRIX="value %d"' % (count % 2) for count in range(3))
+    images = {}
+    for shared_install in (False, True):
+        work_path = str(tmpdir.join('scripts-%s' % shared_install))
+        t2d = Travis2Docker(yml, work_path=work_path, os_kwargs=os_kwargs(),
+                            shared_install=shared_install, bake=True)
+        scripts = t2d.compute_dockerfile()
+        dockerfiles = []
+        for script in scripts:
+            with open(os.path.join(script, 'Dockerfile')) as f_dockerfile:
+                dockerfiles.append(f_dockerfile.read())
+        # The jobs with the same build context build the same image
+        images[shared_install] = [job.image for job in t2d.iter_jobs()]
+        with open(os.path.join(work_path, 'docker-bake.hcl')) as f_bake:
+            assert 'targets = ["job-1", "job-2"]' in f_bake.read()
+        global_pos = dockerfiles[0].index('ENV VARIABLE_GLOBAL="value global"')
+        matrix_pos = dockerfiles[0].index('VARIABLE_MATRIX="value 0"')
+        run_pos = dockerfiles[0].index('RUN /bin/bash -c')
+        assert global_pos < run_pos
+        # The scripts of the entrypoint do not change the install layers
+        assert run_pos < dockerfiles[0].index(
+            'ADD --chown=root:root files/entrypoint.sh /entrypoint.sh\n'
+            'ADD --chown=root:root ./files/script /script\n')
+        assert (run_pos < matrix_pos) == shared_install
+        if shared_install:
+            # Everything but the last ENV is the same for all the jobs
+            prefixes = set(dockerfile[:dockerfile.rindex('\nENV ')]
+                           for dockerfile in dockerfiles)
+            assert len(prefixes) == 1
+    assert images[False] == images[True] == [
+        'owner-project:master_1', 'owner-project:master_2',
+        'owner-project:master_1']
+    # An install using a variable of the matrix needs it before
+    t2d = Travis2Docker(
+        yml.replace('touch install', 'touch ${VARIABLE_MATRIX}'),
+        work_path=str(tmpdir.join('scripts-used')), os_kwargs=os_kwargs(),
+        shared_install=True)
+    script = t2d.compute_dockerfile()[0]
+    with open(os.path.join(script, 'Dockerfile')) as f_dockerfile:
+        content = f_dockerfile.read()
+    assert content.index('VARIABLE_MATRIX="value 0"') < \
+        content.index('RUN /bin/bash -c')
+
+
+def test_git_bundle(tmpdir):
+    bundle = tmpdir.join('sha-refs_heads_master.bundle')
+    bundle.write('bundle')
+    yml = MATRIX_YML % '  - VARIABLE_MATRIX="value"'
+    t2d = Travis2Docker(yml, work_path=str(tmpdir.join('scripts')),
+                        os_kwargs=os_kwargs(), git_bundle=str(bundle))
+    script, = t2d.compute_dockerfile()
+    assert os.path.isfile(os.path.join(script, bundle.basename))
+    with open(os.path.join(script, 'Dockerfile')) as f_dockerfile:
+        content = f_dockerfile.read()
+    # The layers before the bundle do not change with the commit
+    assert 'ADD sha-refs_heads_master.bundle /t2d.bundle\n' \
+        'RUN git init ${TRAVIS_BUILD_DIR}' in content
+    assert 'git fetch --update-head-ok -p /t2d.bundle' in content
+
+
+def test_copy_path_store(tmpdir):
+    work_path = str(tmpdir.join('scripts'))
+    cache_path = str(tmpdir.join('cache'))
+    rcdir = tmpdir.mkdir('rcdir')
+    rcdir.join('rcfile').write('alias ll="ls -l"')
+    yml = MATRIX_YML % '\n'.join(
+        '  - VARIABLE_MATRIX="value %d"' % count for count in range(2))
+    for content in ('alias ll="ls -l"', 'alias ll="ls -la"'):
+        rcdir.join('rcfile').write(content)
+        t2d = Travis2Docker(yml, work_path=work_path, os_kwargs=os_kwargs(),
+                            copy_paths=[(str(rcdir), '$HOME/rcdir')],
+                            cache_path=cache_path)
+        scripts = t2d.compute_dockerfile()
+        staged_path, _ = t2d.store.stage(str(rcdir))
+        for script in scripts:
+            rcfile = os.path.join(script, 'rcdir', 'rcfile')
+            assert os.path.samefile(
+                rcfile, os.path.join(staged_path, 'rcfile'))
+            with open(rcfile) as f_rcfile:
+                assert f_rcfile.read() == content
+    # The copy of the previous content was removed
+    assert sorted(os.listdir(os.path.join(cache_path, 'store'))) == [
+        os.path.basename(os.path.dirname(staged_path)), 'index.marshal']
+
+
+def test_load_yml_cache(tmpdir, monkeypatch):
+    cache_path = str(tmpdir.join('yml'))
+    yml = MATRIX_YML % '  - VARIABLE_MATRIX="value"'
+    data = travis2docker.load_yml(yml, cache_path)
+    assert data['install'] == ['export INSTALLED=1', 'touch install']
+    blob_sha = subprocess.Popen(
+        ['git', 'hash-object', '--stdin'], stdin=subprocess.PIPE,
+        stdout=subprocess.PIPE).communicate(yml.encode('utf-8'))[0]
+    assert os.listdir(cache_path) == [
+        blob_sha.decode('utf-8').strip() + '.marshal']
+
+    def load(*args, **kwargs):
+        raise AssertionError("The yml should not be parsed")
+    monkeypatch.setattr(travis2docker.yaml, 'load', load)
+    assert travis2docker.load_yml(yml, cache_path) == data
+    t2d = Travis2Docker(yml, cache_path=str(tmpdir))
+    assert t2d.yml == data
+    monkeypatch.undo()
+
+    # The least recently used are evicted
+    monkeypatch.setattr(travis2docker, 'YML_CACHE_SIZE', 1024)
+    for count in range(20):
+        travis2docker.load_yml(yml + '# %d' % count, cache_path)
+    assert 1 < len(os.listdir(cache_path)) < 20
+    assert os.path.isfile(os.path.join(cache_path, blob_sha.decode(
+        'utf-8').strip() + '.marshal')) is False
+
+
+def test_get_apt_sources(tmpdir):
+    json_path = tmpdir.join('ubuntu.json')
+    cache_path = str(tmpdir.join('cache'))
+    json_path.write(json.dumps([
+        {'alias': 'pov-wkhtmltopdf', 'key_url': None,
+         'sourceline': 'ppa:pov/wkhtmltopdf'},
+    ]))
+    index = travis2docker.get_apt_sources(str(json_path), cache_path)
+    assert index['pov-wkhtmltopdf'][0]['sourceline'] == 'ppa:pov/wkhtmltopdf'
+    assert len(os.listdir(cache_path)) == 1
+    # Parsed once per process
+    assert travis2docker.get_apt_sources(str(json_path)) is index
+
+    # The marshal cache is used by a new process until the json changes
+    travis2docker._apt_sources.clear()
+    assert travis2docker.get_apt_sources(str(json_path), cache_path) == index
+    json_path.write(json.dumps([
+        {'alias': 'pov-wkhtmltopdf', 'key_url': None,
+         'sourceline': 'ppa:pov/wkhtmltopdf-new'},
+    ]))
+    os.utime(str(json_path), (0, 0))
+    travis2docker._apt_sources.clear()
+    index = travis2docker.get_apt_sources(str(json_path), cache_path)
+    assert index['pov-wkhtmltopdf'][0]['sourceline'] == \
+        'ppa:pov/wkhtmltopdf-new'
+    travis2docker._apt_sources.clear()
+
+
+def test_jinja_env(tmpdir, monkeypatch):
+    templates_path = tmpdir.mkdir('templates')
+    for fname in os.listdir(templating.TEMPLATES_PATH):
+        shutil.copy(os.path.join(templating.TEMPLATES_PATH, fname),
+                    str(templates_path))
+    cache_path = str(tmpdir.join('cache'))
+    yml = MATRIX_YML % '  - VARIABLE_MATRIX="value"'
+    t2d = Travis2Docker(yml, work_path=str(tmpdir.join('scripts')),
+                        templates_path=str(templates_path),
+                        os_kwargs=os_kwargs(), cache_path=cache_path)
+    scripts = t2d.compute_dockerfile()
+    assert Travis2Docker(yml, templates_path=str(templates_path),
+                         cache_path=cache_path).jinja_env is t2d.jinja_env
+    assert len(os.listdir(os.path.join(cache_path, 'jinja'))) == 5
+
+    # The templates changed are loaded again
+    templates_path.join('20-run.sh').write('# custom run')
+    os.utime(str(templates_path.join('20-run.sh')), (0, 0))
+    t2d = Travis2Docker(yml, work_path=str(tmpdir.join('scripts')),
+                        templates_path=str(templates_path),
+                        os_kwargs=os_kwargs(), cache_path=cache_path)
+    t2d.compute_dockerfile()
+    with open(os.path.join(scripts[0], '20-run.sh')) as f_run:
+        assert f_run.read() == '# custom run'
+
+    # The bundled templates are loaded from the modules compiled
+    compiled_path = str(tmpdir.join('compiled'))
+    templating.compile_templates(templating.TEMPLATES_PATH, compiled_path)
+    assert templating.is_compiled(templating.TEMPLATES_PATH, compiled_path)
+    assert not templating.is_compiled(str(templates_path), compiled_path)
+    # The permissions of the templates installed do not matter
+    installed_path = tmpdir.join('installed')
+    shutil.copytree(templating.TEMPLATES_PATH, str(installed_path))
+    for template in installed_path.listdir():
+        template.chmod(0o600)
+    assert templating.is_compiled(str(installed_path), compiled_path)
+    monkeypatch.setattr(templating, 'COMPILED_TEMPLATES_PATH', compiled_path)
+    monkeypatch.setattr(templating, '_jinja_envs', {})
+    work_path = str(tmpdir.join('scripts_compiled'))
+    t2d = Travis2Docker(yml, work_path=work_path, os_kwargs=os_kwargs())
+    assert isinstance(t2d.jinja_env.loader, templating.jinja2.ModuleLoader)
+    t2d.compute_dockerfile()
+    tree = read_tree(work_path)
+    shutil.rmtree(work_path)
+    monkeypatch.undo()
+    t2d = Travis2Docker(yml, work_path=work_path, os_kwargs=os_kwargs())
+    assert isinstance(t2d.jinja_env.loader,
+                      templating.jinja2.FileSystemLoader)
+    t2d.compute_dockerfile()
+    assert read_tree(work_path) == tree
+
+
+def import_times(module):
+    """Get the cumulative import time in microseconds of the modules
+    imported by `module` with the output of `python -X importtime`"""
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path))
+    output = subprocess.Popen(
+        [sys.executable, '-X', 'importtime', '-c', 'import ' + module],
+        stderr=subprocess.PIPE, env=env).communicate()[1].decode('utf-8')
+    times = {}
+    for line in output.splitlines()[1:]:
+        _, cumulative, name = line.split('|')
+        times[name.strip()] = int(cumulative)
+    return times
+
+
+@pytest.mark.skipif(sys.version_info < (3, 7),
+                    reason="-X importtime requires python>=3.7")
+def test_cli_import_time():
+    times = import_times('travis2docker.cli')
+    for heavy_module in ('jinja2', 'yaml', 'travis2docker.travis2docker',
+                         'multiprocessing.pool'):
+        assert heavy_module not in times
+    # The budget is relative to the module generating the scripts so it
+    # does not depend on the speed of the machine
+    budget = import_times('travis2docker.travis2docker')
+    assert times['travis2docker.cli'] < \
+        budget['travis2docker.travis2docker'] / 2
+
+
+def test_main_result_cache(tmpdir, monkeypatch, capsys):
+    monkeypatch.setenv('HOME', str(tmpdir))
+    tmpdir.mkdir('.ssh')
+    yml_path = tmpdir.join('.travis.yml')
+    yml_path.write(MATRIX_YML % '  - VARIABLE_MATRIX=1\n  - VARIABLE_MATRIX=2')
+    argv = ['foo', 'master', '--no-clone', '--travis-yml-path', str(yml_path),
+            '--root-path', str(tmpdir.join('root'))]
+    scripts = main(argv)
+    assert len(scripts) == 2
+
+    def compute_dockerfile(*args, **kwargs):
+        raise AssertionError("The result cache was not used")
+    original_compute_dockerfile = Travis2Docker.compute_dockerfile
+    monkeypatch.setattr(Travis2Docker, 'compute_dockerfile',
+                        compute_dockerfile)
+    capsys.readouterr()
+    assert main(argv) == scripts
+    assert 'reused' in capsys.readouterr().err
+
+    # Other options or a script changed generate the scripts again
+    monkeypatch.setattr(Travis2Docker, 'compute_dockerfile',
+                        original_compute_dockerfile)
+    assert main(argv + ['--docker-user', 'odoo']) == scripts
+    assert 'written: 2,' in capsys.readouterr().err
+    with open(os.path.join(scripts[0], '10-build.sh'), 'a') as f_build:
+        f_build.write('# changed\n')
+    main(argv + ['--docker-user', 'odoo'])
+    assert 'reused' not in capsys.readouterr().err
+    main(argv + ['--force'])
+    assert 'reused' not in capsys.readouterr().err
+
+    # The bake file is removed without --bake and written again with it
+    bake_path = os.path.join(os.path.dirname(scripts[0]), 'docker-bake.hcl')
+    main(argv + ['--bake'])
+    assert os.path.isfile(bake_path)
+    main(argv)
+    assert not os.path.exists(bake_path)
+    main(argv + ['--bake'])
+    assert 'reused' not in capsys.readouterr().err
+    with open(bake_path, 'a') as f_bake:
+        f_bake.write('# changed\n')
+    main(argv + ['--bake'])
+    assert 'reused' not in capsys.readouterr().err
+    with open(bake_path) as f_bake:
+        assert '# changed' not in f_bake.read()
+
+    # The jobs of a bigger matrix generated meanwhile are removed
+    argv[-1] = str(tmpdir.join('stale'))
+    yml_path.write(MATRIX_YML % '  - VARIABLE_MATRIX=1')
+    scripts = main(argv)
+    yml_path.write(MATRIX_YML % '  - VARIABLE_MATRIX=1\n  - VARIABLE_MATRIX=2')
+    scripts = main(argv)
+    assert len(scripts) == 2
+    yml_path.write(MATRIX_YML % '  - VARIABLE_MATRIX=1')
+    capsys.readouterr()
+    assert main(argv) == scripts[:1]
+    assert 'reused' not in capsys.readouterr().err
+    assert not os.path.exists(scripts[1])
+    assert main(argv) == scripts[:1]
+    assert 'reused' in capsys.readouterr().err
+
+
 def test_main():
     # TODO: fix duplicated code
     dirname_example = os.path.join(